@@ -0,0 +1,285 @@
+"""
+End to end load test, with no network access needed.
+
+It seeds a database with users following shipments, starts a stub
+OCA server and a stub Telegram Bot API, and runs the real Sched,
+Database, Providers and Bot against them until every shipment was
+polled once (or --duration runs out). Then it reports polls per
+second, poll latency, database lock wait and notifications sent.
+
+    python benchmarks/loadtest.py --users 1000 --shipments 5000 --latency 0.2 --failure-rate 0.05
+"""
+# Module imports
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import logging as log
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import metrics
+from bot import Bot
+from database import Database
+from providers import Providers
+from scheduler import Sched
+
+TOKEN = "123456:ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghi"
+STATES = ["Ingresado", "En tránsito", "En sucursal de destino", "En distribución", "Entregado"]
+
+# ------------ Stub servers ------------ #
+def serve(handler) -> ThreadingHTTPServer:
+    """
+    Serves handler on a free local port, from a daemon thread
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def oca_server(latency, failure_rate, change_rate) -> ThreadingHTTPServer:
+    """
+    Answers like OCA's GetTracking. Every request takes latency
+    seconds, fails with failure_rate and adds a new event to the
+    shipment with change_rate.
+    """
+    histories = {}
+    lock = threading.Lock()
+    start = 1609502400000
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            tracknum = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["numberOfSend"]
+            time.sleep(latency)
+
+            if random.random() < failure_rate:
+                self._reply(500, b"{}")
+                return
+
+            with lock:
+                count = histories.get(tracknum, random.randint(1, len(STATES) - 1))
+                if random.random() < change_rate:
+                    count += 1
+                histories[tracknum] = count
+
+            rows = [
+                {
+                    "Date":         "/Date({})/".format(start + i * 3600000),
+                    "State":        STATES[min(i, len(STATES) - 1)] + "   ",
+                    "Sucursal":     "SUC. {} ".format(i)
+                } for i in range(count)]
+            self._reply(200, json.dumps({"d": rows}).encode())
+
+        def _reply(self, status, body):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return serve(Handler)
+
+
+def telegram_server() -> ThreadingHTTPServer:
+    """
+    Bot API that accepts every message. server.sent counts them.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            method = self.path.rsplit("/", 1)[-1]
+            try:
+                data = json.loads(body or b"{}")
+            except ValueError:
+                data = {}
+
+            if method == "sendMessage":
+                with server.lock:
+                    server.sent += 1
+                result = {
+                    "message_id":   server.sent,
+                    "date":         int(time.time()),
+                    "chat":         {"id": int(data.get("chat_id", 0)), "type": "private"},
+                    "text":         data.get("text", "")
+                }
+            elif method == "getMe":
+                result = {"id": 123456, "is_bot": True, "first_name": "bot", "username": "bot"}
+            else:
+                result = True
+
+            reply = json.dumps({"ok": True, "result": result}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = serve(Handler)
+    server.sent = 0
+    server.lock = threading.Lock()
+    return server
+
+# ------------ Seeder ------------ #
+def seed(path, users, shipments, per_user):
+    """
+    Fills the database at path with users following per_user
+    random shipments out of shipments, all of them oca's
+    """
+    db = Database(path)
+    tracknums = ["LT{:010d}".format(i) for i in range(shipments)]
+    rows = []
+    for user in range(1, users + 1):
+        for i, tracknum in enumerate(random.sample(tracknums, min(per_user, shipments))):
+            rows.append((user, tracknum, "oca", "envio " + str(i)))
+
+    # Shipments nobody picked still get one follower
+    followed = {row[1] for row in rows}
+    rows.extend((1, tracknum, "oca", tracknum) for tracknum in tracknums if tracknum not in followed)
+
+    with db._transaction() as conn:
+        conn.executemany(
+            "INSERT INTO track_nums (user, tracknum, company, name) VALUES (?, ?, ?, ?) ON CONFLICT DO NOTHING", rows)
+    return len(rows)
+
+# ------------ Report ------------ #
+def quantile(histogram, q, **labels) -> float:
+    """
+    Estimates a quantile from the histogram buckets of every
+    label set matching labels, like Prometheus does
+    """
+    buckets = {}
+    for suffix, labels_, value in histogram.samples():
+        if suffix == "_bucket" and all(labels_.get(name) == value_ for name, value_ in labels.items()):
+            le = float(labels_["le"])
+            buckets[le] = buckets.get(le, 0) + value
+    if not buckets:
+        return 0.0
+
+    bounds = sorted(buckets)
+    rank = q * buckets[bounds[-1]]
+    lower, below = 0.0, 0
+    for upper in bounds:
+        count = buckets[upper]
+        if count >= rank:
+            if upper == float("inf"):
+                return lower
+            return lower + (upper - lower) * (rank - below) / max(count - below, 1)
+        lower, below = upper, count
+    return lower
+
+
+def total(metric, suffix="", **labels) -> float:
+    return sum(
+        value for suffix_, labels_, value in metric.samples()
+        if suffix_ == suffix and all(labels_.get(name) == value_ for name, value_ in labels.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end load test with stub OCA and Telegram servers.")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--shipments", type=int, default=1000)
+    parser.add_argument("--per-user", type=int, default=3, help="shipments followed by each user")
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds per OCA request")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--change-rate", type=float, default=0.2, help="chance a poll finds a new event")
+    parser.add_argument("--tick", type=float, default=1, help="seconds between dispatcher runs")
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--duration", type=float, default=120, help="max seconds to run")
+    parser.add_argument("--db", help="database to seed, a temporary one if not given")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="show the bot logs")
+    args = parser.parse_args()
+
+    # Failed polls would flood the output otherwise
+    if not args.verbose:
+        log.disable(log.ERROR)
+
+    random.seed(args.seed)
+    tmp = None
+    if args.db is None:
+        tmp = tempfile.mkdtemp()
+        args.db = os.path.join(tmp, "database.db")
+
+    followers = seed(args.db, args.users, args.shipments, args.per_user)
+    print("Seeded {} follows of {} shipments by {} users".format(followers, args.shipments, args.users))
+
+    oca = oca_server(args.latency, args.failure_rate, args.change_rate)
+    telegram = telegram_server()
+
+    # Real classes, pointed to the stubs
+    prov = Providers()
+    prov.get_carrier("oca").url = "http://127.0.0.1:{}/GetTracking".format(oca.server_port)
+    db = Database(args.db)
+    sch = Sched(db, prov, batch_size=args.batch_size)
+    bot = Bot(sch, db, prov, TOKEN, base_url="http://127.0.0.1:{}/bot".format(telegram.server_port))
+    sch.bot = bot
+
+    # Shipments are loaded in the background, wait for them
+    deadline = time.time() + args.duration
+    while "oca" not in sch.queues or len(sch.queues["oca"].due) < args.shipments:
+        if time.time() > deadline:
+            sch.sched.shutdown(wait=False)
+            prov.close()
+            sys.exit("Shipments weren't loaded after {:.0f} s".format(args.duration))
+        time.sleep(0.1)
+
+    # Everything due now, polled as fast as the settings allow
+    sch.sched.reschedule_job("dispatch_oca", trigger="interval", seconds=args.tick)
+    queue = sch.queues["oca"]
+    now = time.time()
+    for tracknum in list(queue.due):
+        queue.push(tracknum, now)
+
+    polls = metrics.REGISTRY.metrics["scheduler_polls_total"]
+    start = time.time()
+    while time.time() - start < args.duration:
+        time.sleep(0.5)
+        if total(polls, carrier="oca") >= args.shipments and all(due is not None for due in queue.due.values()):
+            break
+    elapsed = time.time() - start
+
+    # Let the notifier catch up for a bit
+    time.sleep(2)
+    stats = bot.notifier.stats()
+    sch.sched.shutdown(wait=False)
+    prov.close()
+
+    request = metrics.REGISTRY.metrics["provider_request_seconds"]
+    lock_wait = metrics.REGISTRY.metrics["db_lock_wait_seconds"]
+    lag = metrics.REGISTRY.metrics["scheduler_lag_seconds"]
+    errors = metrics.REGISTRY.metrics["provider_errors_total"]
+    polled = total(polls, carrier="oca")
+
+    print("Polled {:.0f} shipments in {:.1f} s".format(polled, elapsed))
+    print("  polls/s:           {:10.1f}".format(polled / elapsed))
+    print("  poll latency p50:  {:10.3f} s".format(quantile(request, 0.5, carrier="oca")))
+    print("  poll latency p99:  {:10.3f} s".format(quantile(request, 0.99, carrier="oca")))
+    print("  provider errors:   {:10.0f}".format(total(errors, carrier="oca")))
+    print("  scheduler lag p99: {:10.3f} s".format(quantile(lag, 0.99, carrier="oca")))
+    print("  db lock wait:      {:10.3f} s total, {:.0f} waits, p99 {:.4f} s".format(
+        total(lock_wait, "_sum"), total(lock_wait, "_count"), quantile(lock_wait, 0.99)))
+    print("  notifications:     {:10d} sent, {:.1f}/s, {} queued, {} failed".format(
+        telegram.sent, telegram.sent / elapsed, stats["queued"], stats["failed"]))
+
+    if tmp is not None:
+        for name in os.listdir(tmp):
+            os.remove(os.path.join(tmp, name))
+        os.rmdir(tmp)
+
+
+if __name__ == "__main__":
+    main()
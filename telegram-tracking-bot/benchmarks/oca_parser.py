@@ -0,0 +1,81 @@
+"""
+Compares the OCA parser against the previous one, which decoded
+the whole response and built a dict per row.
+
+Payloads are shaped like the ones OCA returns, and can be replaced
+by recorded ones passed as arguments (files with the raw response).
+
+    python benchmarks/oca_parser.py [payload.json ...]
+"""
+# Module imports
+import json
+import os
+import random
+import sys
+import timeit
+from datetime import datetime
+import pytz
+
+# Local imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from carriers.oca import Oca
+
+STATES = ["Ingresado", "En tránsito", "En sucursal de destino   ", "En distribución", "Entregado"]
+BRANCHES = ["CENTRO DE DISTRIBUCION   ", "SUC. PALERMO", "SUC. CORDOBA CENTRO", "PLANTA OCA  "]
+
+def make_payload(rows) -> bytes:
+    start = 1609502400000
+    return json.dumps({"d": [
+        {
+            "NumeroEnvio":      "3654000000000245027",
+            "Date":             "/Date({})/".format(start + i * 3600000 + random.randint(0, 59999)),
+            "State":            random.choice(STATES),
+            "Sucursal":         random.choice(BRANCHES),
+            "IdEstado":         i,
+            "Motivo":           "                    "
+        } for i in range(rows)]}).encode()
+
+
+TIMEZONE = pytz.timezone("America/Argentina/Buenos_Aires")
+
+def old_parse(raw, timezone=TIMEZONE) -> list:
+    return_list = []
+    for row in json.loads(raw)["d"]:
+        raw_date = row["Date"].replace("/Date(", "").replace(")/", "")
+        date = datetime.fromtimestamp(int(raw_date)/1e3, tz=timezone).strftime("%Y-%m-%d %H:%M")
+        return_list.append({
+            "date":         date,
+            "description":  row["State"].rstrip(),
+            "location":     row["Sucursal"].rstrip()
+        })
+    return return_list
+
+
+def main():
+    if len(sys.argv) > 1:
+        payloads = []
+        for path in sys.argv[1:]:
+            with open(path, "rb") as file:
+                payloads.append((os.path.basename(path), file.read()))
+    else:
+        payloads = [("{} rows".format(rows), make_payload(rows)) for rows in (10, 50, 200, 1000)]
+
+    oca = Oca()
+    for name, raw in payloads:
+
+        # Both must agree on what they return, times to the minute
+        old = old_parse(raw)
+        new = oca.parse(raw)
+        assert [(row["date"], row["description"], row["location"]) for row in old] \
+            == [(event.date(), event.description, event.location) for event in new]
+        assert all(event.ts % 60 == 0 for event in new)
+
+        number = max(1, 20000 // len(old))
+        old_time = min(timeit.repeat(lambda: old_parse(raw), number=number, repeat=5)) / number
+        new_time = min(timeit.repeat(lambda: oca.parse(raw), number=number, repeat=5)) / number
+        print("{:>10}: old {:8.1f} us, new {:8.1f} us, {:4.1f}x".format(
+            name, old_time * 1e6, new_time * 1e6, old_time / new_time))
+
+
+if __name__ == "__main__":
+    main()
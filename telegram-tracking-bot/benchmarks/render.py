@@ -0,0 +1,60 @@
+"""
+Compares rendering a long history with render.py against the
+previous string concatenation, which sent it all as one message.
+
+    python benchmarks/render.py [events]
+"""
+# Module imports
+import os
+import random
+import sys
+import timeit
+
+# Local imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import render
+from carriers import TIMEZONE, Event
+
+STATES = ["Ingresado", "En tránsito", "En sucursal de destino", "En distribución", "Visita sin éxito"]
+BRANCHES = ["CENTRO DE DISTRIBUCION", "SUC. PALERMO", "SUC. CORDOBA CENTRO", "PLANTA OCA"]
+HEADER = "Tenés nueva información de tu envío: Zapatillas (3654000000000245027)"
+
+def make_events(count) -> list:
+    return [
+        Event(1609502400 + i * 3600, random.choice(STATES), random.choice(BRANCHES))
+        for i in range(count)
+    ]
+
+
+def old_render(events) -> list:
+    list_text = ""
+    for event in events:
+        list_text += "{}\n{}\n{}\n\n".format(
+            event.date(TIMEZONE),
+            event.description,
+            event.location
+        )
+    return [HEADER + "\n" + "\n" + list_text]
+
+
+def new_render(events, keep=None) -> list:
+    return render.chunk(HEADER, render.render_events(events, TIMEZONE, keep))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    events = make_events(count)
+
+    for name, function in (
+        ("old", old_render),
+        ("new", new_render),
+        ("new, last 50", lambda events: new_render(events, 50))):
+        messages = function(events)
+        seconds = min(timeit.repeat(lambda: function(events), number=20, repeat=5)) / 20
+        print("{:>12}: {:8.1f} us, {} messages, longest {} chars{}".format(
+            name, seconds * 1e6, len(messages), max(map(len, messages)),
+            "" if max(map(len, messages)) <= render.MAX_LENGTH else " (too long for Telegram)"))
+
+
+if __name__ == "__main__":
+    main()
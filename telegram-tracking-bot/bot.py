@@ -1,14 +1,40 @@
 # Module imports
 import telegram
-from telegram.ext import Updater
+from telegram.ext import Updater, Defaults
+from telegram.utils.request import Request
 from telegram.ext import CommandHandler, CallbackQueryHandler, ConversationHandler, MessageHandler, Filters, TypeHandler
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 import logging as log
 
+# Local imports
+import render
+from carriers import TIMEZONE
+from notifier import Notifier
+
 class Bot:
-    def __init__(self, sched, database, providers, token):
-        self.bot = telegram.Bot(token=token)
-        self.updater = Updater(token=token, use_context=True)    
+
+    # Events shown in an update, older ones are summarized
+    MAX_EVENTS = 50
+
+    # Threads sending notifications, each needs its own connection
+    NOTIFIER_WORKERS = 2
+
+    def __init__(self, sched, database, providers, token, workers=8, base_url=None):
+        # base_url is only needed for other Bot API servers
+        self.bot = telegram.Bot(token=token, base_url=base_url,
+            request=Request(con_pool_size=self.NOTIFIER_WORKERS))
+        self.notifier = Notifier(self.bot, self.NOTIFIER_WORKERS)
+
+        # Handlers run on the dispatcher pool of workers, so a slow
+        # one (database, live fetch) doesn't hold back other updates
+        self.updater = Updater(
+            token=token,
+            base_url=base_url,
+            use_context=True,
+            workers=workers,
+            defaults=Defaults(run_async=True),
+            request_kwargs={"con_pool_size": workers + 4}
+        )
         self.dispatcher = self.updater.dispatcher
         self.sched = sched
         self.prov = providers
@@ -265,25 +291,23 @@ class Bot:
 
             if query.data == "delete":
 
-                # This gets done only if nobody else has it
-                if not self.db.check_anyone_else_has_tracknum(tracknum, company):
+                # The job only goes if nobody else has it
+                if not self.db.del_tracknum_user(update.effective_chat.id, tracknum, company):
                     self.sched.del_tracknum_job(tracknum, company)
-                    self.db.del_tracknum_info(tracknum, company)
-
-                # This is always
-                self.db.del_tracknum_user(update.effective_chat.id, tracknum, company)
                 context.bot.send_message(
                     chat_id=update.effective_chat.id,
                     text="Tracking borrado exitosamente! Dale /start para volver al menú principal."
                 )
 
             if query.data == "info":
-                info = self.db.get_existing_info(tracknum, company)
-                self.send_update([update.effective_chat.id], tracknum, company, info, False)
-                context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text="Dale /start para volver al menú principal."
-                )
+
+                # Only what wasn't sent to this user yet. None means
+                # a worker process answers instead, prompt included.
+                sent = self.sched.send_unseen(update.effective_chat.id, tracknum, company)
+                if sent is False:
+                    self.send_nothing_new(update.effective_chat.id)
+                if sent is not None:
+                    self.send_menu_prompt(update.effective_chat.id)
             return ConversationHandler.END
 
         def cancel(update, context):
@@ -322,35 +346,65 @@ class Bot:
         self.dispatcher.add_handler(CallbackQueryHandler(main, pattern="contact"))
 
     # ----------- External methods ----------- #
-    def send_update(self, chat_ids: list, tracknum: str,
+    def start(self, webhook_url=None, listen="127.0.0.1", port=8080):
+        """
+        Starts receiving updates, by long polling or, if
+        webhook_url is given, through a local webhook server
+        at listen:port. The token is used as the path so only
+        Telegram knows it, webhook_url should point there
+        (through a reverse proxy with TLS).
+        """
+        if webhook_url:
+            token = self.bot.token
+            self.updater.start_webhook(
+                listen=listen,
+                port=port,
+                url_path=token,
+                webhook_url=webhook_url.rstrip("/") + "/" + token
+            )
+            log.info("Bot receiving updates through webhook on " + listen + ":" + str(port))
+        else:
+            self.updater.start_polling()
+        self.updater.idle()
+
+    def send_update(self, followers: list, tracknum: str,
         company: str, info: list, new: bool):
         """
         Sends new information update to all
-        chat_ids registered to follow that tracking number.
+        followers of that tracking number, given as
+        (chat_id, name) pairs.
+
+        Messages are only enqueued, the notifier sends them.
         """
-        list_text = ""
-
-        # Turns it into string
-        for row in info:
-            list_text += "{}\n{}\n{}\n\n".format(
-                row["date"],
-                row["description"],
-                row["location"]
-            )
-            
-        # Sends update to all chat ids
+        # Body is rendered once, dates in the bot's timezone
+        blocks = render.render_events(info, TIMEZONE, self.MAX_EVENTS)
+
+        # Sends update to all followers
         if new:
             ANSWER_TEXT = "Tenés nueva información de tu envío: "
         else:
             ANSWER_TEXT = "Información existente de tu envío: "
-        for chat_id in chat_ids:
-            name = self.db.get_tracknum_name(tracknum, chat_id, company)
-            self.bot.send_message(
-                chat_id=chat_id,
-                text=ANSWER_TEXT + "{} ({})\n".format(name, tracknum)
-                     + "\n"
-                     + list_text
-            )
+
+        # Only the header changes with the name, long ones take many messages
+        texts = {}
+        for chat_id, name in followers:
+            if name not in texts:
+                texts[name] = render.chunk(ANSWER_TEXT + "{} ({})".format(name, tracknum), blocks)
+            for text in texts[name]:
+                self.notifier.send(chat_id, text)
+
+    def send_nothing_new(self, chat_id):
+        """
+        Tells a user there's no new information
+        """
+        self.notifier.send(chat_id, "No hay información nueva de este envío.")
+
+    def send_menu_prompt(self, chat_id):
+        """
+        Points a user back to the main menu, queued after
+        any update sent to it before
+        """
+        self.notifier.send(chat_id, "Dale /start para volver al menú principal.")
 
     # ------------ Static methods ------------ #
     @staticmethod
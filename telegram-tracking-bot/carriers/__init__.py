@@ -0,0 +1,185 @@
+"""
+Tracking companies supported by the bot.
+
+Each carrier lives in its own module with a Carrier subclass, and
+is only imported the first time it's used. Besides the built-in
+ones listed in CARRIERS, other packages can add carriers through
+the "telegram_tracking_bot.carriers" entry point group, pointing
+to their Carrier subclass.
+"""
+# Module imports
+import importlib
+import logging as log
+from collections import namedtuple
+from datetime import datetime
+from importlib.metadata import entry_points
+import pytz
+
+# Built-in carriers, name -> ("module:class", real name)
+CARRIERS = {
+    "oca":  ("carriers.oca:Oca", "Oca"),
+}
+
+ENTRY_POINT_GROUP = "telegram_tracking_bot.carriers"
+
+# How dates are shown to users
+TIMEZONE = pytz.timezone("America/Argentina/Buenos_Aires")
+DATE_FORMAT = "%Y-%m-%d %H:%M"
+
+class Event(namedtuple("Event", ["ts", "description", "location"])):
+    """
+    One event of a shipment history. ts is kept as an epoch in
+    seconds and is only turned into a date when it's shown.
+    """
+    __slots__ = ()
+
+    def date(self, timezone=TIMEZONE) -> str:
+        return datetime.fromtimestamp(self.ts, tz=timezone).strftime(DATE_FORMAT)
+
+
+class IntervalPolicy():
+    """
+    Decides how often a shipment gets polled, from its latest
+    description and how long it has been without changes.
+
+    Quiet shipments back off exponentially up to maximum, and so do
+    the ones whose polls keep failing or finding nothing (like a
+    mistyped number). The ones out for delivery are polled every
+    minimum, and delivered ones stop being polled after grace.
+    Descriptions are matched in lowercase against the keyword lists.
+    """
+    def __init__(self, base=30*60, minimum=10*60, maximum=6*60*60,
+        quiet=24*60*60, grace=2*24*60*60,
+        out_for_delivery=("en distribuci", "en reparto"), delivered=("entregad",)):
+        self.base = base
+        self.minimum = minimum
+        self.maximum = maximum
+        self.quiet = quiet
+        self.grace = grace
+        self.out_for_delivery = out_for_delivery
+        self.delivered = delivered
+
+    def interval(self, description, quiet_for, failures=0):
+        """
+        Param:
+            - description: latest description, can be None
+            - quiet_for: seconds since the history last changed
+            - failures: consecutive polls that got no data
+
+        Returns:
+            - Seconds until next poll, or None to stop polling
+        """
+        text = (description or "").lower()
+
+        if any(word in text for word in self.delivered):
+            return None if quiet_for >= self.grace else self.base
+
+        if any(word in text for word in self.out_for_delivery):
+            return self.minimum
+
+        # Double it for every quiet period or failed poll
+        steps = min(max(int(quiet_for // self.quiet), failures), 16)
+        return min(self.base * 2 ** steps, self.maximum)
+
+
+class Carrier():
+    """
+    Common interface of every carrier.
+
+    Subclasses set url (used to pool connections per host) and
+    implement fetch() and parse(). They can also implement
+    fetch_many() if their API takes many tracking numbers per
+    request, up to batch_size of them, and replace policy to
+    suggest other poll intervals.
+    """
+    name = None
+    real_name = None
+    url = None
+    batch_size = 50
+
+    def __init__(self):
+        self.policy = IntervalPolicy()
+
+    async def fetch(self, session, tracknum):
+        """
+        Gets the raw data of a tracking number using the given
+        aiohttp session. Returns None if the request failed.
+        """
+        raise NotImplementedError
+
+    def parse(self, raw) -> list:
+        """
+        Turns raw data into a list of Events.
+        """
+        raise NotImplementedError
+
+    async def fetch_many(self, session, tracknums) -> dict:
+        """
+        Optional, gets the raw data of at most batch_size tracking
+        numbers in one request. Returns a dict of tracknum -> raw
+        data, leaving out (or None) the ones the API had no data
+        for, or None if the whole request failed.
+        """
+        raise NotImplementedError
+
+    @property
+    def supports_batch(self) -> bool:
+        return type(self).fetch_many is not Carrier.fetch_many
+
+
+def available() -> dict:
+    """
+    Returns every known carrier as name -> ("module:class", real name),
+    without importing any of them.
+    """
+    carriers = dict(CARRIERS)
+    try:
+        found = entry_points()
+        if hasattr(found, "select"):
+            found = found.select(group=ENTRY_POINT_GROUP)
+        else:
+            found = found.get(ENTRY_POINT_GROUP, [])     # Python < 3.10
+
+        for entry in found:
+            carriers.setdefault(entry.name, (entry.value, entry.name.capitalize()))
+    except Exception as inst:
+        log.error("carriers: available() entry_points exception = " + type(inst).__name__ + " - " + str(inst.args[0:]))
+    return carriers
+
+
+def load(name, spec=None) -> Carrier:
+    """
+    Imports a carrier and returns an instance of it.
+
+    If spec ("module:class") isn't given, it looks for a module
+    with that name in this package. Returns None if not found.
+    """
+    if spec is None:
+        if not name.isidentifier():
+            log.error("carriers: load() = Invalid carrier name " + name)
+            return None
+        spec = "carriers." + name + ":"
+
+    module_name, _, class_name = spec.partition(":")
+    try:
+        module = importlib.import_module(module_name)
+    except ImportError:
+        log.error("carriers: load() = No carrier named " + name)
+        return None
+
+    if class_name:
+        carrier = getattr(module, class_name)
+    else:
+        # Only subclass in the module
+        carrier = next(
+            (value for value in vars(module).values()
+             if isinstance(value, type) and issubclass(value, Carrier) and value is not Carrier),
+            None)
+        if carrier is None:
+            log.error("carriers: load() = No Carrier subclass in " + module_name)
+            return None
+
+    log.info("carriers: load() = Loaded carrier " + name)
+    instance = carrier()
+    instance.name = instance.name or name
+    return instance
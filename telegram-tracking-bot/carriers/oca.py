@@ -0,0 +1,64 @@
+# Module imports
+import json
+import logging as log
+import re
+
+# Local imports
+from carriers import Carrier, Event
+
+# Epoch in milliseconds of "/Date(1609502400000)/"
+DATE_PATTERN = re.compile(r"/Date\((-?\d+)")
+
+class Oca(Carrier):
+    """
+    Gets tracking data from oca
+    """
+    name = "oca"
+    real_name = "Oca"
+    url = "http://www5.oca.com.ar/ocaepakNet/Views/ConsultaTracking/TrackingConsult.aspx/GetTracking"
+
+    async def fetch(self, session, tracknum):
+        """
+        Param:
+            - session: aiohttp session for oca
+            - tracknum: tracking number
+
+        Returns:
+            - Raw json response, or None on errors
+        """
+        try:
+            async with session.post(self.url, json={"numberOfSend": tracknum}) as response:
+
+                # Check for errors
+                if response.status != 200:
+                    log.error("oca: fetch() status_code exception = " + str(response.status))
+                    return
+
+                return await response.read()
+        except Exception as inst:
+            log.error("oca: fetch() session.post exception = " + type(inst).__name__ + " - " + str(inst.args[0:]))
+            return
+
+    def parse(self, raw) -> list:
+        """
+        Decodes the response in a single pass, turning each
+        row into an Event as soon as the decoder builds it
+
+        Returns:
+            - List of Events
+        """
+        return json.loads(raw, object_hook=self._event)["d"]
+
+    @staticmethod
+    def _event(row):
+        """
+        Times are kept to the minute, like the stored dates,
+        so stored histories match new polls
+        """
+        if "Date" not in row:
+            return row
+        return Event(
+            int(DATE_PATTERN.match(row["Date"]).group(1)) // 60000 * 60,
+            row["State"].rstrip(),
+            row["Sucursal"].rstrip()
+        )
@@ -1,35 +1,150 @@
 import sqlite3
 from sqlite3 import Error
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
 import threading
+import time
 import logging as log
 
+# Local imports
+import metrics
+from carriers import DATE_FORMAT, TIMEZONE, Event
+
+QUERY_SECONDS = metrics.REGISTRY.histogram(
+    "db_query_seconds", "Time spent in each Database method", ["method"])
+LOCK_WAIT_SECONDS = metrics.REGISTRY.histogram(
+    "db_lock_wait_seconds", "Time spent waiting for the database write lock", ["method"])
+
+def _timed(method):
+    """
+    Records how long each call to a Database method takes
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.local.method = method.__name__
+        start = time.perf_counter()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            QUERY_SECONDS.observe(time.perf_counter() - start, method=method.__name__)
+    return wrapper
+
+def _events_to_epoch(conn):
+    """
+    Migration that turns the event dates into epochs, numbering
+    the events of each shipment in order
+    """
+    conn.execute(
+        """ CREATE TABLE track_info_new (
+            tracknum    TEXT,
+            company     TEXT,
+            seq         INTEGER,
+            ts          INTEGER,
+            description TEXT,
+            location    TEXT,
+            PRIMARY KEY (tracknum, company, seq)
+        ) WITHOUT ROWID; """)
+
+    rows = conn.execute(
+        "SELECT tracknum, company, date, description, location FROM track_info ORDER BY tracknum, company, date, rowid"
+        ).fetchall()
+    seqs = {}
+    events = []
+    for tracknum, company, date, description, location in rows:
+        seqs[(tracknum, company)] = seq = seqs.get((tracknum, company), 0) + 1
+        ts = int(TIMEZONE.localize(datetime.strptime(date, DATE_FORMAT)).timestamp())
+        events.append((tracknum, company, seq, ts, description, location))
+    conn.executemany("INSERT INTO track_info_new VALUES (?, ?, ?, ?, ?, ?)", events)
+
+    conn.execute("DROP TABLE track_info")
+    conn.execute("ALTER TABLE track_info_new RENAME TO track_info")
+    conn.execute("CREATE UNIQUE INDEX track_info_ts ON track_info (tracknum, company, ts, description, location)")
+
 class Database:
-    def __init__(self):
+    """
+    Every thread gets its own connection, in WAL mode, so readers
+    don't wait on writers. Writes take the database write lock
+    up front (BEGIN IMMEDIATE) and wait up to busy_timeout for it.
+    """
+    def __init__(self, path='database.db', busy_timeout=5.0,
+        cache_size=-16000, mmap_size=64*1024*1024):
+
+        # Connection settings
+        self.path = path
+        self.busy_timeout = busy_timeout    # in seconds
+        self.cache_size = cache_size        # pages, or KiB if negative
+        self.mmap_size = mmap_size          # in bytes
 
-        # Define lock for threads
-        self.lock = threading.Lock()
+        # Connections are per thread
+        self.local = threading.local()
 
-        # Create connection and cursor
-        self.conn = sqlite3.connect('database.db', check_same_thread=False)
-        self.cursor = self.conn.cursor()
+        # Recently used history fingerprints, (tracknum, company) -> hash
+        self.hashes = OrderedDict()
+        self.hashes_lock = threading.Lock()
+        self.HASH_CACHE_SIZE = 10000
 
-        # Make tables
+        # Write-through index of track_nums, so the bot menus
+        # don't touch disk. Only holds what this process wrote,
+        # besides what was loaded at startup.
+        self.names = {}         # user -> {name: (tracknum, company)}
+        self.followers = {}     # (tracknum, company) -> {user: name}
+        self.index_lock = threading.Lock()
+
+        # Make tables and bring them up to date
         self._make_tables()
+        self._migrate()
+        self._load_index()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """
+        Connection of the calling thread, opened the first time
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            # Autocommit, transactions are explicit with _transaction()
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA cache_size=" + str(int(self.cache_size)))
+            conn.execute("PRAGMA mmap_size=" + str(int(self.mmap_size)))
+            conn.execute("PRAGMA busy_timeout=" + str(int(self.busy_timeout * 1000)))
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Write transaction on the calling thread's connection,
+        committed on exit or rolled back on error
+        """
+        conn = self.conn
+        start = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        LOCK_WAIT_SECONDS.observe(time.perf_counter() - start, method=getattr(self.local, "method", "other"))
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
 
     def _make_tables(self):
 
         # Create tracking numbers table
-        with self.lock:
-            self.cursor.execute(
+        with self._transaction() as conn:
+            conn.execute(
                 """ CREATE TABLE IF NOT EXISTS track_nums (
                     user        INTEGER,
                     tracknum    TEXT,
                     company     TEXT,
                     name        TEXT
                 ); """)
-            
+
             # Create tracking info table
-            self.cursor.execute(
+            conn.execute(
                 """ CREATE TABLE IF NOT EXISTS track_info (
                     tracknum    TEXT,
                     company     TEXT,
@@ -37,260 +152,559 @@ class Database:
                     description TEXT,
                     location    TEXT
                 ); """)
-        
 
-            # Commit (don't know if necessary, just in case)
-            self.conn.commit()
+    # Schema migrations, applied in order on startup. The database
+    # user_version holds how many of them have been applied. Each
+    # step is a statement, or a function taking the connection.
+    MIGRATIONS = [
+        # 1: Unique constraints and indexes
+        [
+            """ CREATE TABLE track_nums_new (
+                user        INTEGER,
+                tracknum    TEXT,
+                company     TEXT,
+                name        TEXT,
+                UNIQUE (user, tracknum, company)
+            ); """,
+            "INSERT OR IGNORE INTO track_nums_new SELECT user, tracknum, company, name FROM track_nums",
+            "DROP TABLE track_nums",
+            "ALTER TABLE track_nums_new RENAME TO track_nums",
+            "CREATE INDEX track_nums_tracknum ON track_nums (tracknum, company)",
+            "CREATE INDEX track_nums_name ON track_nums (user, name)",
+            """ CREATE TABLE track_info_new (
+                tracknum    TEXT,
+                company     TEXT,
+                date        TEXT,
+                description TEXT,
+                location    TEXT,
+                UNIQUE (tracknum, company, date, description, location)
+            ); """,
+            "INSERT OR IGNORE INTO track_info_new SELECT tracknum, company, date, description, location FROM track_info",
+            "DROP TABLE track_info",
+            "ALTER TABLE track_info_new RENAME TO track_info"
+        ],
+        # 2: Fingerprint of the last polled history
+        [
+            """ CREATE TABLE track_state (
+                tracknum    TEXT,
+                company     TEXT,
+                hash        TEXT,
+                PRIMARY KEY (tracknum, company)
+            ) WITHOUT ROWID; """
+        ],
+        # 3: Time of the last history change
+        [
+            "ALTER TABLE track_state ADD COLUMN changed INTEGER"
+        ],
+        # 4: Epoch timestamps and a sequence number per shipment
+        [
+            _events_to_epoch
+        ],
+        # 5: Last event sent to each follower, everything stored was already sent
+        [
+            "ALTER TABLE track_nums ADD COLUMN last_seq INTEGER NOT NULL DEFAULT 0",
+            """ UPDATE track_nums SET last_seq = (
+                SELECT COALESCE(MAX(seq), 0) FROM track_info
+                WHERE track_info.tracknum=track_nums.tracknum AND track_info.company=track_nums.company
+            ) """
+        ],
+        # 6: Shard leases of the poller workers and their inbox
+        [
+            """ CREATE TABLE shard_owners (
+                owner       TEXT PRIMARY KEY,
+                expires     REAL
+            ); """,
+            """ CREATE TABLE shard_leases (
+                shard       INTEGER PRIMARY KEY,
+                owner       TEXT,
+                expires     REAL
+            ); """,
+            """ CREATE TABLE commands (
+                id          INTEGER PRIMARY KEY AUTOINCREMENT,
+                shard       INTEGER,
+                action      TEXT,
+                user        INTEGER,
+                tracknum    TEXT,
+                company     TEXT
+            ); """,
+            "CREATE INDEX commands_shard ON commands (shard, id)"
+        ],
+        # 7: Time of the last successful poll
+        [
+            "ALTER TABLE track_state ADD COLUMN polled INTEGER"
+        ],
+        # 8: Poll schedule, interval is 0 once polling stopped
+        [
+            "ALTER TABLE track_state ADD COLUMN due REAL",
+            "ALTER TABLE track_state ADD COLUMN interval INTEGER",
+            "ALTER TABLE track_state ADD COLUMN failures INTEGER NOT NULL DEFAULT 0"
+        ]
+    ]
+
+    def _migrate(self):
+        """
+        Upgrades the schema in place, one migration per transaction
+        """
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+        for number, statements in enumerate(self.MIGRATIONS[version:], start=version + 1):
+            log.info("database: _migrate() = Upgrading schema to version " + str(number))
+            with self._transaction() as conn:
+                for statement in statements:
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.execute(statement)
+                conn.execute("PRAGMA user_version = " + str(number))
+
+    def _load_index(self):
+        """
+        Loads every follower into the in-memory index
+        """
+        cursor = self.conn.execute("SELECT user, tracknum, company, name FROM track_nums")
+        with self.index_lock:
+            for user, tracknum, company, name in cursor:
+                self._index_add(user, tracknum, company, name)
+
+    def _index_add(self, user, tracknum, company, name):
+        """
+        Must hold index_lock
+        """
+        self.names.setdefault(user, {})[name] = (tracknum, company)
+        self.followers.setdefault((tracknum, company), {})[user] = name
+
+    def _index_del(self, user, tracknum, company):
+        """
+        Must hold index_lock
+        """
+        followers = self.followers.get((tracknum, company), {})
+        name = followers.pop(user, None)
+        if not followers:
+            self.followers.pop((tracknum, company), None)
+
+        names = self.names.get(user, {})
+        if name is not None and names.get(name) == (tracknum, company):
+            del names[name]
+        if not names:
+            self.names.pop(user, None)
 
     # ------------ Add --------------- #
+    @_timed
     def add_tracknum(self, chat_id, tracknum, company, name):
         """
         Adds tracknum to database
         """
-        with self.lock, self.conn:
-            self.cursor.execute(
-                "INSERT INTO track_nums VALUES (:user, :tracknum, :company, :name)",
-                {
-                    'user':         chat_id,
-                    'tracknum':     tracknum,
-                    'company':      company.lower(),
-                    'name':         name
-                }
-            )    
+        with self.index_lock:
+            with self._transaction() as conn:
+                cursor = conn.execute(
+                    "INSERT INTO track_nums (user, tracknum, company, name) VALUES (:user, :tracknum, :company, :name) ON CONFLICT DO NOTHING",
+                    {
+                        'user':         chat_id,
+                        'tracknum':     tracknum,
+                        'company':      company.lower(),
+                        'name':         name
+                    }
+                )
 
-    def add_tracknum_info(self, tracknum, date, company, description, location) -> bool:
+            if cursor.rowcount == 1:
+                self._index_add(chat_id, tracknum, company.lower(), name)
+
+    @_timed
+    def add_tracknum_info_bulk(self, tracknum, company, events, fingerprint=None) -> list:
         """
-        Adds new gathered info to database
+        Adds the whole gathered history of a tracknum to database,
+        in a single transaction. If given, the fingerprint of the
+        history is stored along with it, and so is the time of the
+        change if there's any new event.
 
-        Returns True if new data, False if existing data.
+        New events are numbered after the last stored one, in
+        time order. Returns the events that were new, sorted.
+        Nothing is stored if nobody follows the tracknum anymore.
         """
+        params = {
+            'tracknum':     tracknum,
+            'company':      company
+        }
+        with self._transaction() as conn:
+            if not conn.execute(
+                "SELECT 1 FROM track_nums WHERE tracknum=:tracknum AND company=:company LIMIT 1",
+                params).fetchone():
+                return []
+
+            cursor = conn.execute(
+                "SELECT ts, description, location FROM track_info WHERE tracknum=:tracknum AND company=:company",
+                params)
+            existing = set(cursor.fetchall())
 
-        exists = self._check_tracknum_info_exists(tracknum, date, company, description, location)
-        
-        if not exists:
-            with self.lock, self.conn:
-                self.cursor.execute(
-                    "INSERT INTO track_info VALUES (:track_num, :company, :date, :description, :location)",
+            new_events = []
+            for event in sorted(events):
+                event = Event(*event)
+                if event not in existing:
+                    existing.add(event)
+                    new_events.append(event)
+
+            if new_events:
+                last = conn.execute(
+                    "SELECT MAX(seq) FROM track_info WHERE tracknum=:tracknum AND company=:company",
+                    params).fetchone()[0] or 0
+                conn.executemany(
+                    "INSERT INTO track_info VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING",
+                    [(tracknum, company, seq) + event for seq, event in enumerate(new_events, start=last + 1)]
+                )
+
+            if fingerprint:
+                conn.execute(
+                    "INSERT INTO track_state (tracknum, company, hash, changed) VALUES (:tracknum, :company, :hash, :changed) "
+                    "ON CONFLICT (tracknum, company) DO UPDATE SET hash=excluded.hash, changed=COALESCE(excluded.changed, changed)",
                     {
-                        'track_num':        tracknum,
-                        'company':          company,
-                        'date':             date,
-                        'description':      description,
-                        'location':         location
-                    },
-                    )
-            return True
-        else:
-            return False
+                        'tracknum':     tracknum,
+                        'company':      company,
+                        'hash':         fingerprint,
+                        'changed':      int(time.time()) if new_events else None
+                    })
+
+        if fingerprint:
+            self._cache_hash(tracknum, company, fingerprint)
+        return new_events
+
+    @_timed
+    def set_poll_states(self, company, states):
+        """
+        Stores the poll state of many tracknums in a single
+        transaction. states is a list of (tracknum, polled, due,
+        interval, failures), polled is None if the poll failed.
+        Tracknums nobody follows anymore are skipped.
+        """
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT INTO track_state (tracknum, company, polled, due, interval, failures) "
+                "SELECT :tracknum, :company, :polled, :due, :interval, :failures "
+                "WHERE EXISTS (SELECT 1 FROM track_nums WHERE tracknum=:tracknum AND company=:company) "
+                "ON CONFLICT (tracknum, company) DO UPDATE SET polled=COALESCE(excluded.polled, polled), "
+                "due=excluded.due, interval=excluded.interval, failures=excluded.failures",
+                [
+                    {
+                        'tracknum':     tracknum,
+                        'company':      company,
+                        'polled':       polled and int(polled),
+                        'due':          due,
+                        'interval':     interval,
+                        'failures':     failures
+                    } for tracknum, polled, due, interval, failures in states
+                ])
 
     # ------------ Del --------------- #
-    def del_tracknum_user(self, chat_id, tracknum, company):
+    @_timed
+    def del_tracknum_user(self, chat_id, tracknum, company) -> int:
         """
-        Deletes tracking number from user database
+        Deletes tracking number from user database. If nobody
+        else follows it, its info and poll state go with it, in
+        the same transaction.
+
+        Returns how many followers are left.
         """
-        with self.lock, self.conn:
-            self.cursor.execute(
-                "DELETE from track_nums WHERE user=:user AND tracknum=:tracknum",
-                {
-                    'user':         chat_id,
-                    'tracknum':    tracknum
-                })
-        
-    def del_tracknum_info(self, tracknum, company):
+        params = {
+            'user':         chat_id,
+            'tracknum':     tracknum,
+            'company':      company
+        }
+        with self.index_lock:
+            with self._transaction() as conn:
+                conn.execute(
+                    "DELETE from track_nums WHERE user=:user AND tracknum=:tracknum AND company=:company",
+                    params)
+                left = conn.execute(
+                    "SELECT COUNT(*) FROM track_nums WHERE tracknum=:tracknum AND company=:company",
+                    params).fetchone()[0]
+                if not left:
+                    conn.execute("DELETE from track_info WHERE tracknum=:tracknum AND company=:company", params)
+                    conn.execute("DELETE from track_state WHERE tracknum=:tracknum AND company=:company", params)
+
+            self._index_del(chat_id, tracknum, company)
+
+        if not left:
+            self.forget_tracknum_hash(tracknum, company)
+        return left
+
+    def forget_tracknum_hash(self, tracknum, company):
         """
-        Deletes tracking number from info database
+        Drops the cached fingerprint of a tracknum, for when its
+        history was deleted, maybe by another process
         """
-        with self.lock, self.conn:
-            self.cursor.execute(
-                "DELETE from track_info WHERE tracknum=:tracknum AND company=:company",
-                {
-                    'tracknum':    tracknum,
-                    'company':     company
-                })
-    
+        with self.hashes_lock:
+            self.hashes.pop((tracknum, company), None)
+
     # ------------ Check --------------- #
+    @_timed
     def check_tracknum_exists(self, chat_id, tracknum, company):
         """
         Check if tracknum exists for a given user.
-        
+
         If it doesn't, it returns False.
         If it does, it returns the name given by the user.
         """
+        with self.index_lock:
+            return self.followers.get((tracknum, company), {}).get(chat_id, False)
 
-        with self.lock:
-            self.cursor.execute(
-                "SELECT name FROM track_nums WHERE user=:user AND tracknum=:tracknum AND company=:company",
-                {
-                    'user':        chat_id,
-                    'tracknum':    tracknum,
-                    'company':     company
-                })
-
-            # Shouldn't be more than one, so only fetchone
-            data = self.cursor.fetchone()
+    @_timed
+    def check_name_exists(self, chat_id, name):
+        """
+        Check if name exists for a given user.
 
+        If it doesn't, it returns False.
+        If it does, it returns the associated tracknum.
+        """
+        with self.index_lock:
+            data = self.names.get(chat_id, {}).get(name)
         if not data:
             return(False)
         else:
             return(data[0])
 
-    def check_name_exists(self, chat_id, name):
+    # ------------ Get --------------- #
+    @_timed
+    def get_user_tracknums(self, chat_id) -> list:
         """
-        Check if name exists for a given user.
-        
-        If it doesn't, it returns False.
-        If it does, it returns the associated tracknum.
+        Returns names associated with id
         """
+        with self.index_lock:
+            return [(tracknum, name) for name, (tracknum, _) in self.names.get(chat_id, {}).items()]
 
-        with self.lock:
-            self.cursor.execute(
-                "SELECT tracknum FROM track_nums WHERE user=:user AND name=:name",
-                {
-                    'user':        chat_id,
-                    'name':        name
-                })
+    @_timed
+    def count_followers(self, tracknum, company) -> int:
+        """
+        Returns how many users follow a tracknum, read from disk
+        since other processes may have changed them
+        """
+        cursor = self.conn.execute(
+            "SELECT COUNT(*) FROM track_nums WHERE tracknum=:tracknum AND company=:company",
+            {
+                'tracknum':     tracknum,
+                'company':      company
+            })
+        return cursor.fetchone()[0]
 
-            # Shouldn't be more than one, so only fetchone
-            data = self.cursor.fetchone()
+    @_timed
+    def get_shipments(self):
+        """
+        Returns every followed tracknum once, as rows of tracknum,
+        company and its poll state: last successful poll (epoch),
+        next due time, interval and consecutive failures. The state
+        is None if it was never polled.
 
-        if not data:
-            return(False)
-        else:
-            return(data[0])
-    
-    def check_anyone_else_has_tracknum(self, tracknum, company):
+        Rows are streamed from a cursor, so they're read as
+        they're iterated, in the calling thread.
         """
-        Checks if more than one person has this tracknumg.
+        return self.conn.execute(
+            """ SELECT n.tracknum, n.company, s.polled, s.due, s.interval, COALESCE(s.failures, 0)
+                FROM (SELECT DISTINCT tracknum, company FROM track_nums) n
+                LEFT JOIN track_state s ON s.tracknum=n.tracknum AND s.company=n.company """)
 
-        If it does it returns True,
-        else it returns False.
+    @_timed
+    def take_unseen_events(self, tracknum, company, chat_id=None) -> list:
         """
-        with self.lock:
-            self.cursor.execute(
-                "SELECT user FROM track_nums WHERE tracknum=:tracknum",
-                {
-                    'tracknum':    tracknum
-                })
+        Gets the events each follower of a tracknum (or only
+        chat_id) wasn't sent yet, and marks them as sent.
+
+        Returns a list of (followers, events), where followers
+        is a list of (chat_id, name) that share the same unseen
+        events, sorted by time.
+        """
+        params = {
+            'tracknum':     tracknum,
+            'company':      company,
+            'user':         chat_id
+        }
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "SELECT user, name, last_seq FROM track_nums WHERE tracknum=:tracknum AND company=:company "
+                "AND (:user IS NULL OR user=:user)",
+                params)
+            by_seq = {}
+            for user, name, last_seq in cursor:
+                by_seq.setdefault(last_seq, []).append((user, name))
+            if not by_seq:
+                return []
 
-            data = self.cursor.fetchall()
+            cursor = conn.execute(
+                "SELECT seq, ts, description, location FROM track_info WHERE tracknum=:tracknum AND company=:company "
+                "AND seq>:seq ORDER BY seq",
+                dict(params, seq=min(by_seq)))
+            events = [(row[0], Event(*row[1:])) for row in cursor]
+            if not events:
+                return []
 
-        if len(data) <= 1:
-            return(False)
-        else:
-            return(True)
+            conn.execute(
+                "UPDATE track_nums SET last_seq=:seq WHERE tracknum=:tracknum AND company=:company "
+                "AND last_seq<:seq AND (:user IS NULL OR user=:user)",
+                dict(params, seq=events[-1][0]))
+
+        unseen = []
+        for last_seq, followers in by_seq.items():
+            new = sorted(event for seq, event in events if seq > last_seq)
+            if new:
+                unseen.append((followers, new))
+        return unseen
 
-    def _check_tracknum_info_exists(self, tracknum, date, company, description, location) -> bool:
+    @_timed
+    def get_tracknum_and_company_by_name(self, chat_id, name):
+        """
+        Returns tracknum and company by giving the id and name
         """
-        Check if tracknum info exists or not.
+        with self.index_lock:
+            return self.names.get(chat_id, {}).get(name)
 
-        If it doesn't it returns False,
-        else it returns True.
+    @_timed
+    def get_tracknum_hash(self, tracknum, company) -> str:
         """
-        with self.lock:
-            self.cursor.execute(
-                "SELECT tracknum FROM track_info WHERE tracknum=:tracknum AND company=:company AND date=:date AND description=:description AND location=:location",
-                {
-                    'tracknum':    tracknum,
-                    'company':     company,
-                    'date':        date,
-                    'description': description,
-                    'location':    location
-                })
+        Returns the fingerprint of the last stored history
+        of a tracknum, or None if there isn't one.
+        """
+        key = (tracknum, company)
+        with self.hashes_lock:
+            if key in self.hashes:
+                self.hashes.move_to_end(key)
+                return self.hashes[key]
 
-            # Shouldn't be more than one, so only fetchone
-            data_exists = self.cursor.fetchone()
+        cursor = self.conn.execute(
+            "SELECT hash FROM track_state WHERE tracknum=:tracknum AND company=:company",
+            {
+                'tracknum':     tracknum,
+                'company':      company
+            })
+        data = cursor.fetchone()
 
-        if not data_exists:
-            return(False)
-        else:
-            return(True)
-    
-    # ------------ Get --------------- #
-    def get_user_tracknums(self, chat_id) -> list:
+        fingerprint = data[0] if data else None
+        self._cache_hash(tracknum, company, fingerprint)
+        return fingerprint
+
+    @_timed
+    def get_tracknum_activity(self, tracknum, company) -> tuple:
         """
-        Returns names associated with id
-        """    
-        with self.lock:
-            self.cursor.execute(
-                "SELECT tracknum, name FROM track_nums WHERE user=:user",
-                {'user': chat_id}
-                )
-            track_name_list = self.cursor.fetchall()
-        return(track_name_list)
+        Returns the latest description of a tracknum and the
+        time (epoch) its history last changed, both may be None.
+
+        Histories stored before changes were tracked have no
+        change time, their latest event time is used instead.
+        """
+        cursor = self.conn.execute(
+            """ SELECT
+                (SELECT description FROM track_info WHERE tracknum=:tracknum AND company=:company
+                    ORDER BY ts DESC LIMIT 1),
+                COALESCE(
+                    (SELECT changed FROM track_state WHERE tracknum=:tracknum AND company=:company),
+                    (SELECT MAX(ts) FROM track_info WHERE tracknum=:tracknum AND company=:company)) """,
+            {
+                'tracknum':     tracknum,
+                'company':      company
+            })
+        return cursor.fetchone()
 
-    def get_tracknums_and_company(self):
+    def _cache_hash(self, tracknum, company, fingerprint):
         """
-        Returns a list with every tracknum and its company.
-        Used when rebooting bot and adding all jobs.
+        Stores fingerprint in the LRU cache
         """
-        with self.lock:
-            self.cursor.execute("SELECT tracknum, company FROM track_nums")
-            track_company_list = self.cursor.fetchall()    
-        return(track_company_list)
-        
-    def get_ids_for_tracknum(self, tracknum, company) -> list:
+        key = (tracknum, company)
+        with self.hashes_lock:
+            self.hashes[key] = fingerprint
+            self.hashes.move_to_end(key)
+            if len(self.hashes) > self.HASH_CACHE_SIZE:
+                self.hashes.popitem(last=False)
+
+    @_timed
+    def get_existing_info(self, tracknum, company):
         """
-        Returns a list of all chat_ids that are following
-        a given tracknum and company.
+        Returns the history of a tracknum as a list of
+        Events sorted by time, or None if there isn't any.
         """
-        with self.lock:
-            self.cursor.execute(
-                "SELECT user FROM track_nums WHERE tracknum=:tracknum AND company=:company",
-                {
-                    'tracknum':    tracknum,
-                    'company':     company
-                })
-            data_tuple = self.cursor.fetchall()
-        
-        data = [user[0] for user in data_tuple]     # Get out of tuple
-        return data
+        cursor = self.conn.execute(
+            "SELECT ts, description, location FROM track_info WHERE tracknum=:tracknum AND company=:company ORDER BY ts",
+            {
+                'tracknum':     tracknum,
+                'company':      company
+            })
+        events = [Event(*row) for row in cursor]
+        return events or None
 
-    def get_tracknum_name(self, tracknum, chat_id, company) -> str:
+    # ------------ Shards --------------- #
+    @_timed
+    def lease_shards(self, owner, count, ttl) -> list:
         """
-        Return name for a given tracknum and company
+        Renews the shard leases of owner and takes free or
+        expired ones, up to a fair share among the live owners.
+        Shards above that share are let go for others to take.
+
+        Returns the shards leased by owner, for the next ttl seconds,
+        and how many owners are alive.
         """
-        with self.lock:
-            self.cursor.execute(
-                "SELECT name FROM track_nums WHERE tracknum=:tracknum AND company=:company AND user=:user",
+        now = time.time()
+        with self._transaction() as conn:
+
+            # Owners say they're alive even if they have no shards yet
+            conn.execute(
+                "INSERT INTO shard_owners VALUES (:owner, :expires) ON CONFLICT (owner) DO UPDATE SET expires=excluded.expires",
                 {
-                    'tracknum':    tracknum,
-                    'company':     company,
-                    'user':        chat_id
+                    'owner':        owner,
+                    'expires':      now + ttl
                 })
-            return self.cursor.fetchone()[0]
+            conn.execute("DELETE FROM shard_owners WHERE expires<=:now", {'now': now})
+            live = {row[0] for row in conn.execute("SELECT owner FROM shard_owners")}
 
-    def get_tracknum_and_company_by_name(self, chat_id, name):
+            leases = conn.execute("SELECT shard, owner, expires FROM shard_leases").fetchall()
+            taken = {shard for shard, lease_owner, expires in leases if lease_owner != owner and expires > now}
+            fair = -(-count // len(live))
+
+            # Keep the ones already leased first
+            owned = sorted(shard for shard, lease_owner, _ in leases if lease_owner == owner and shard < count)
+            free = [shard for shard in range(count) if shard not in taken and shard not in owned]
+            mine = (owned + free)[:fair]
+            extra = [shard for shard, lease_owner, _ in leases if lease_owner == owner and shard not in mine]
+
+            conn.executemany(
+                "DELETE FROM shard_leases WHERE shard=? AND owner=?",
+                [(shard, owner) for shard in extra])
+            conn.executemany(
+                "INSERT INTO shard_leases VALUES (?, ?, ?) ON CONFLICT (shard) DO UPDATE SET owner=excluded.owner, expires=excluded.expires",
+                [(shard, owner, now + ttl) for shard in mine])
+        return mine, len(live)
+
+    @_timed
+    def release_shards(self, owner):
         """
-        Returns tracknum and company by giving the id and name
-        """   
-        with self.lock:
-            self.cursor.execute(
-                "SELECT tracknum, company FROM track_nums WHERE user=:user AND name=:name",
-                {
-                    'user':     chat_id,
-                    'name':     name
-                })
-            return self.cursor.fetchone()
+        Lets go every shard leased by owner
+        """
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM shard_leases WHERE owner=:owner", {'owner': owner})
+            conn.execute("DELETE FROM shard_owners WHERE owner=:owner", {'owner': owner})
 
-    def get_existing_info(self, tracknum, company):
-        with self.lock:
-            self.cursor.execute(
-                "SELECT date, description, location FROM track_info WHERE tracknum=:tracknum AND company=:company",
+    @_timed
+    def add_command(self, shard, action, chat_id, tracknum, company):
+        """
+        Leaves a command for the worker that owns shard
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO commands (shard, action, user, tracknum, company) VALUES (:shard, :action, :user, :tracknum, :company)",
                 {
+                    'shard':        shard,
+                    'action':       action,
+                    'user':         chat_id,
                     'tracknum':     tracknum,
                     'company':      company
                 })
-            unordered_info = self.cursor.fetchall()
-        if unordered_info:
-            data = []
-            for info in unordered_info:
-                data.append(
-                    {
-                        "date":         info[0],
-                        "description":  info[1],
-                        "location":     info[2]
-                    }
-                )
-            return data
-        else:
-            return
\ No newline at end of file
+
+    @_timed
+    def take_commands(self, shards) -> list:
+        """
+        Removes and returns the pending commands of shards, in
+        order, as a list of (action, chat_id, tracknum, company).
+        """
+        if not shards:
+            return []
+        with self._transaction() as conn:
+            marks = ",".join("?" * len(shards))
+            rows = conn.execute(
+                "SELECT id, action, user, tracknum, company FROM commands WHERE shard IN (" + marks + ") ORDER BY id",
+                list(shards)).fetchall()
+            conn.executemany("DELETE FROM commands WHERE id=?", [(row[0], ) for row in rows])
+        return [row[1:] for row in rows]
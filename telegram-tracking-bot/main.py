@@ -1,12 +1,15 @@
 # Module imports
+import argparse
+import threading
 import logging as log
-import sys
 
 # Local imports
+import metrics
 from bot import Bot
 from database import Database
 from providers import Providers
 from scheduler import Sched
+from shards import Remote, Shards
 
 # Log config
 log.basicConfig(
@@ -18,26 +21,52 @@ log.basicConfig(
 def main():
     """ Main function """
     
-    # Get token from args
-    if len(sys.argv) == 2:
-        token = sys.argv[1]
-    elif len(sys.argv) == 1:
+    # Get token and options from args
+    parser = argparse.ArgumentParser(description="Bot de Telegram para seguir envíos.")
+    parser.add_argument("token", nargs="?", help="token del bot generado en Telegram")
+    parser.add_argument("--metrics-port", type=int, help="puerto local donde exponer las métricas en /metrics")
+    parser.add_argument("--webhook-url", help="URL pública del webhook, si no se usa long polling")
+    parser.add_argument("--webhook-listen", default="127.0.0.1", help="dirección local del servidor del webhook")
+    parser.add_argument("--webhook-port", type=int, default=8080, help="puerto local del servidor del webhook")
+    parser.add_argument("--workers", type=int, default=8, help="cantidad de updates atendidos a la vez")
+    parser.add_argument("--mode", choices=["all", "frontend", "worker"], default="all",
+        help="all: un solo proceso. frontend: solo atiende Telegram. worker: solo consulta los envíos de sus shards")
+    parser.add_argument("--shards", type=int, default=16, help="cantidad de shards, igual en todos los procesos")
+    parser.add_argument("--batch-size", type=int, default=50, help="máximo de envíos consultados por empresa en cada ronda")
+    args = parser.parse_args()
+
+    if args.token is None:
         print("Error: por favor generar token y usarlo como argumento para correr el bot.")
         return
-    else:
-        print("Error: se debe utilizar sólo 1 argumento que será el token del bot generado en Telegram.")
-        return
+    token = args.token
+
+    # Metrics exporter, only if asked for
+    if args.metrics_port:
+        metrics.start_http_server(args.metrics_port)
 
     # Initialize classes
     prov = Providers()
     db = Database()
-    sch = Sched(db, prov)
-    bot = Bot(sch, db, prov, token)
+    if args.mode == "all":
+        sch = Sched(db, prov, batch_size=args.batch_size)
+    elif args.mode == "frontend":
+        sch = Remote(db, args.shards)
+    else:
+        shards = Shards(db, args.shards)
+        sch = Sched(db, prov, shards, args.batch_size)
+    bot = Bot(sch, db, prov, token, args.workers)
     sch.bot = bot
-    
+
+    # Workers only use the bot to send updates
+    if args.mode == "worker":
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            shards.release()
+        return
+
     # Start bot
-    bot.updater.start_polling()
-    bot.updater.idle()
+    bot.start(args.webhook_url, args.webhook_listen, args.webhook_port)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,182 @@
+# Module imports
+import bisect
+import threading
+import logging as log
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class Metric():
+    """
+    Base of every metric. Values are kept per tuple of label
+    values, in the same order as labelnames.
+    """
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _key(self, labels) -> tuple:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> list:
+        """
+        Returns a list of (suffix, labels dict, value)
+        """
+        with self.lock:
+            return [("", dict(zip(self.labelnames, key)), value) for key, value in self.values.items()]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Gauge that is either set, or read from callback when
+    collected. The callback returns a dict of label values
+    tuple -> value.
+    """
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames=(), callback=None):
+        super().__init__(name, help, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self) -> list:
+        if self.callback is None:
+            return super().samples()
+        try:
+            values = self.callback()
+        except Exception:
+            log.exception("metrics: Gauge.samples() = Error collecting " + self.name)
+            return []
+        return [("", dict(zip(self.labelnames, key)), value) for key, value in values.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    # In seconds
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self, name, help, labelnames=(), buckets=BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0, 0]    # counts, sum, count
+            entry = self.values[key]
+            if i < len(self.buckets):
+                entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self) -> list:
+        samples = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                labels = dict(zip(self.labelnames, key))
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append(("_bucket", dict(labels, le=repr(float(bound))), cumulative))
+                samples.append(("_bucket", dict(labels, le="+Inf"), count))
+                samples.append(("_sum", labels, total))
+                samples.append(("_count", labels, count))
+        return samples
+
+
+class Registry():
+    """
+    Holds every metric and renders them in the Prometheus
+    text exposition format
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name, help, labelnames=()) -> Counter:
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=(), callback=None) -> Gauge:
+        gauge = self._add(Gauge(name, help, labelnames, callback))
+        if callback is not None:
+            gauge.callback = callback   # Latest owner wins
+        return gauge
+
+    def histogram(self, name, help, labelnames=(), buckets=Histogram.BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for suffix, labels, value in metric.samples():
+                lines.append("{}{}{} {}".format(metric.name, suffix, self._labels(labels), value))
+        return "\n".join(lines) + "\n"
+
+    def _add(self, metric):
+        """
+        Registers metric, or returns the one already registered with that name
+        """
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    @staticmethod
+    def _labels(labels) -> str:
+        if not labels:
+            return ""
+        escaped = (
+            '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+            for name, value in labels.items()
+        )
+        return "{" + ",".join(escaped) + "}"
+
+
+# Default registry used by every module
+REGISTRY = Registry()
+
+
+def start_http_server(port, addr="127.0.0.1", registry=REGISTRY):
+    """
+    Serves the registry on http://addr:port/metrics from a daemon thread
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((addr, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log.info("metrics: start_http_server() = Serving metrics on " + addr + ":" + str(port))
+    return server
@@ -0,0 +1,214 @@
+# Module imports
+import heapq
+import itertools
+import threading
+import time
+import logging as log
+from telegram.error import RetryAfter, TimedOut
+
+# Local imports
+import metrics
+
+SENT = metrics.REGISTRY.counter("notifications_sent_total", "Messages sent")
+THROTTLED = metrics.REGISTRY.counter("notifications_throttled_total", "Messages throttled by Telegram (RetryAfter)")
+DELAYED = metrics.REGISTRY.counter("notifications_delayed_total", "Messages delayed by the per chat limit")
+RETRIED = metrics.REGISTRY.counter("notifications_retried_total", "Messages retried after timing out")
+FAILED = metrics.REGISTRY.counter("notifications_failed_total", "Messages that couldn't be sent")
+
+class TokenBucket:
+    """
+    Token bucket rate limiter. It refills rate tokens per second,
+    holding at most burst of them.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token, sleeping until there's one available
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            self.burst = max(rate, 1)
+            self.tokens = min(self.tokens, self.burst)
+
+
+class Notifier:
+    """
+    Outbound message queue for the bot.
+
+    Messages get sent by their own worker threads, limited by a
+    global token bucket and a minimum gap between messages to the
+    same chat. Messages throttled by Telegram (RetryAfter) or that
+    timed out are put back in the queue and retried later. Only one
+    message per chat is sent at a time, and the later messages of
+    a chat wait for the one being retried, so they keep their order.
+    """
+    def __init__(self, bot, workers=2, rate=30, chat_rate=1, retries=3):
+        self.bot = bot
+        self.rate = rate
+        self.retries = retries
+        self.chat_gap = 1 / chat_rate   # seconds between messages to a chat
+
+        # Heap of (ready time, sequence, chat_id, text, attempt)
+        self.queue = []
+        self.cond = threading.Condition()
+        self.seq = itertools.count()
+        self.chats = {}     # chat_id -> next time a message can be sent to it
+        self.busy = {}      # chat_id -> sequence of its message being sent or retried
+        self.held = {}      # chat_id -> messages waiting for the busy one
+
+        # Global limit
+        self.limiter = TokenBucket(rate, rate)
+
+        # Counters
+        self.sent = 0
+        self.throttled = 0
+        self.retried = 0
+        self.failed = 0
+
+        metrics.REGISTRY.gauge(
+            "notifications_queued", "Messages waiting to be sent",
+            callback=lambda: {(): self.stats()["queued"]})
+
+        for i in range(workers):
+            threading.Thread(target=self._worker, name="notifier-" + str(i), daemon=True).start()
+
+    def send(self, chat_id, text):
+        """
+        Enqueues a message, returns right away
+        """
+        self._push(time.monotonic(), next(self.seq), chat_id, text, 0)
+
+    def share(self, count):
+        """
+        Takes a 1/count share of the global limit, for when
+        count processes send messages with the same bot
+        """
+        rate = self.rate / max(count, 1)
+        if rate != self.limiter.rate:
+            log.info("notifier: share() = Sending up to " + str(round(rate, 1)) + " messages per second")
+            self.limiter.set_rate(rate)
+
+    def stats(self) -> dict:
+        """
+        Returns queue length and message counters
+        """
+        with self.cond:
+            return {
+                "queued":       len(self.queue) + sum(len(held) for held in self.held.values()),
+                "sent":         self.sent,
+                "throttled":    self.throttled,
+                "retried":      self.retried,
+                "failed":       self.failed
+            }
+
+    def _push(self, ready, seq, chat_id, text, attempt):
+        with self.cond:
+            heapq.heappush(self.queue, (ready, seq, chat_id, text, attempt))
+            self.cond.notify()
+
+    def _next(self) -> tuple:
+        """
+        Waits until a message is ready and its chat can receive it
+        """
+        with self.cond:
+            while True:
+                if not self.queue:
+                    self.cond.wait()
+                    continue
+
+                now = time.monotonic()
+                ready, seq, chat_id, text, attempt = self.queue[0]
+                if ready > now:
+                    self.cond.wait(ready - now)
+                    continue
+                heapq.heappop(self.queue)
+
+                # Another message of this chat goes first
+                if self.busy.get(chat_id, seq) != seq:
+                    self.held.setdefault(chat_id, []).append((ready, seq, chat_id, text, attempt))
+                    continue
+
+                # Too soon for this chat, keeping its sequence keeps the order
+                chat_ready = self.chats.get(chat_id, 0)
+                if chat_ready > now:
+                    DELAYED.inc()
+                    heapq.heappush(self.queue, (chat_ready, seq, chat_id, text, attempt))
+                    continue
+                self.chats[chat_id] = now + self.chat_gap
+                self.busy[chat_id] = seq
+                self._prune_chats(now)
+                return seq, chat_id, text, attempt
+
+    def _done(self, chat_id):
+        """
+        Lets the held messages of a chat go, once its busy one
+        was sent or given up on
+        """
+        with self.cond:
+            self.busy.pop(chat_id, None)
+            for message in self.held.pop(chat_id, []):
+                heapq.heappush(self.queue, message)
+            self.cond.notify_all()
+
+    def _prune_chats(self, now):
+        """
+        Forgets chats that can already receive messages. Must hold the lock.
+        """
+        if len(self.chats) > 1000:
+            self.chats = {chat_id: ready for chat_id, ready in self.chats.items() if ready > now}
+
+    def _worker(self):
+        while True:
+            seq, chat_id, text, attempt = self._next()
+            self.limiter.acquire()
+            try:
+                self.bot.send_message(chat_id=chat_id, text=text)
+                with self.cond:
+                    self.sent += 1
+                SENT.inc()
+                self._done(chat_id)
+
+            except RetryAfter as inst:
+                log.warning("notifier: _worker() = Throttled, retrying in " + str(inst.retry_after) + " s")
+                with self.cond:
+                    self.throttled += 1
+                THROTTLED.inc()
+                self._push(time.monotonic() + inst.retry_after, seq, chat_id, text, attempt)
+
+            except TimedOut:
+                if attempt < self.retries:
+                    with self.cond:
+                        self.retried += 1
+                    RETRIED.inc()
+                    self._push(time.monotonic() + 2 ** attempt, seq, chat_id, text, attempt + 1)
+                else:
+                    log.error("notifier: _worker() = Timed out sending to " + str(chat_id))
+                    with self.cond:
+                        self.failed += 1
+                    FAILED.inc()
+                    self._done(chat_id)
+
+            except Exception as inst:
+                log.error("notifier: _worker() exception = " + type(inst).__name__ + " - " + str(inst.args[0:]))
+                with self.cond:
+                    self.failed += 1
+                FAILED.inc()
+                self._done(chat_id)
@@ -1,81 +1,414 @@
 # Module imports
-import requests
+import aiohttp
+import asyncio
+import threading
+import time
 import logging as log
-from datetime import datetime
-import pytz
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
+
+# Local imports
+import carriers
+import metrics
+from carriers import IntervalPolicy
+
+REQUEST_SECONDS = metrics.REGISTRY.histogram(
+    "provider_request_seconds", "Latency of provider requests", ["carrier"])
+REQUEST_ERRORS = metrics.REGISTRY.counter(
+    "provider_errors_total", "Failed provider requests", ["carrier"])
+REQUESTS_REJECTED = metrics.REGISTRY.counter(
+    "provider_rejected_total", "Requests rejected by an open circuit breaker", ["carrier"])
+
+# Result of a request the circuit breaker didn't let through
+REJECTED = object()
+
+class CircuitBreaker():
+    """
+    Circuit breaker of one provider.
+
+    While closed, it keeps the outcome of the last window requests,
+    where requests slower than slow_call count as failures. Once
+    there are at least min_calls and failure_ratio of them failed,
+    it opens and rejects every request for cooldown seconds. Then
+    it goes half-open and lets probes requests through: if they
+    succeed it closes again, otherwise it reopens with the cooldown
+    doubled, up to max_cooldown.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, window=20, min_calls=10, failure_ratio=0.5,
+        slow_call=5.0, cooldown=30, max_cooldown=30*60, probes=1):
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.slow_call = slow_call
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.probes = probes
+
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.outcomes = deque(maxlen=window)   # True if it failed
+        self.cooldown = cooldown
+        self.opened_at = 0
+        self.probing = 0
+        self.opened = 0         # times it opened
+        self.rejected = 0       # requests rejected while open
+        self.latency = 0        # moving average, in seconds
+
+    def allow(self) -> bool:
+        """
+        Returns True if a request can go through now
+        """
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.cooldown:
+                    self.rejected += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self.probing = 0
+
+            if self.state == self.HALF_OPEN:
+                if self.probing >= self.probes:
+                    self.rejected += 1
+                    return False
+                self.probing += 1
+            return True
+
+    def record(self, ok, latency):
+        """
+        Records the outcome of a request that was allowed
+        """
+        failed = not ok or latency > self.slow_call
+        with self.lock:
+            self.latency = latency if not self.latency else 0.9 * self.latency + 0.1 * latency
+
+            if self.state == self.HALF_OPEN:
+                self.probing -= 1
+                if failed:
+                    self._open(min(self.cooldown * 2, self.max_cooldown))
+                else:
+                    log.info("providers: CircuitBreaker = Closed after probe")
+                    self.state = self.CLOSED
+                    self.cooldown = self.base_cooldown
+                    self.outcomes.clear()
+                return
+
+            self.outcomes.append(failed)
+            failures = sum(self.outcomes)
+            if len(self.outcomes) >= self.min_calls and failures >= self.failure_ratio * len(self.outcomes):
+                self._open(self.base_cooldown)
+
+    def retry_in(self) -> float:
+        """
+        Seconds until requests are let through again, 0 if they already are
+        """
+        with self.lock:
+            if self.state != self.OPEN:
+                return 0
+            return max(0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "state":        self.state,
+                "failures":     sum(self.outcomes),
+                "calls":        len(self.outcomes),
+                "latency":      self.latency,
+                "opened":       self.opened,
+                "rejected":     self.rejected
+            }
+
+    def _open(self, cooldown):
+        """
+        Must hold the lock
+        """
+        log.warning("providers: CircuitBreaker = Opened for " + str(cooldown) + " s")
+        self.state = self.OPEN
+        self.cooldown = cooldown
+        self.opened_at = time.monotonic()
+        self.opened += 1
+        self.outcomes.clear()
+
 
 class Providers():
     """
-    This class groups all of the functions to get data from 
+    This class groups all of the functions to get data from
     tracking companies.
+
+    Each company is a carrier module (see carriers), imported the
+    first time it's used. Requests run on an asyncio event loop
+    living in its own thread, with one keep-alive session per
+    provider host and a cap on in-flight requests per provider.
+
+    Concurrent requests for the same tracking number share a single
+    fetch, and its result is cached for cache_ttl seconds.
     """
     def __init__(self):
-        self.supported = ["oca"]
-        self.real_names = ["Oca"]
+        # Known carriers, none of them imported yet
+        self.registry = carriers.available()
+        self.supported = list(self.registry)
+        self.real_names = [real_name for _, real_name in self.registry.values()]
+        self.carriers = {}      # name -> loaded Carrier
+        self.carriers_lock = threading.Lock()
 
         # Define timeout
         self.timeout = 10   # in seconds
-        self.timezone = pytz.timezone("America/Argentina/Buenos_Aires")
-        
+        self.max_in_flight = 10     # per provider
+
+        # Start event loop for requests
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="providers", daemon=True).start()
+        self.sessions = {}      # host -> aiohttp.ClientSession
+        self.semaphores = {}    # company -> asyncio.Semaphore
+
+        # Request coalescing, only used from the event loop
+        self.cache_ttl = 60     # in seconds
+        self.CACHE_SIZE = 10000
+        self.cache = OrderedDict()  # (tracknum, company) -> (expires, data)
+        self.inflight = {}          # (tracknum, company) -> asyncio.Future
+
+        # One circuit breaker per company
+        self.breakers = {}
+        metrics.REGISTRY.gauge(
+            "provider_breaker_state", "Circuit breaker state, 1 for the current one", ["carrier", "state"],
+            callback=lambda: {
+                (company, state["state"]): 1 for company, state in self.stats().items()
+            })
+
     def get(self, tracknum, company):
         """
-        Points to the different get functions according
-        to the given company. If company not supported, returns None.
+        Gets the data of a tracking number from the carrier of the
+        given company. If company not supported, returns None.
+
+        Blocks the calling thread until the request is done.
+        """
+        data = self.run(self._get(tracknum, company))
+        return None if data is REJECTED else data
+
+    def get_policy(self, company) -> IntervalPolicy:
+        """
+        Returns the polling interval policy of a company
+        """
+        carrier = self.get_carrier(company)
+        return carrier.policy if carrier else IntervalPolicy()
+
+    def get_carrier(self, company) -> carriers.Carrier:
+        """
+        Returns the carrier of a company, importing it the first
+        time. Returns None if there's no such carrier.
+        """
+        if company not in self.carriers:
+            with self.carriers_lock:
+                if company not in self.carriers:
+                    spec = self.registry.get(company, (None, None))[0]
+                    self.carriers[company] = carriers.load(company, spec)
+        return self.carriers[company]
+
+    def get_breaker(self, company) -> CircuitBreaker:
+        """
+        Returns the circuit breaker of a company
+        """
+        with self.carriers_lock:
+            if company not in self.breakers:
+                self.breakers[company] = CircuitBreaker()
+            return self.breakers[company]
+
+    def stats(self) -> dict:
         """
-        if company == "oca":
-            return(self._get_oca(tracknum))
+        Returns the circuit breaker stats of each company
+        """
+        return {company: breaker.stats() for company, breaker in list(self.breakers.items())}
+
+    async def get_many(self, tracknums, company) -> dict:
+        """
+        Gets many tracking numbers of the same company concurrently,
+        in one request if the carrier supports it.
+
+        Returns a dict of tracknum -> data, where data is None
+        if that request failed. The ones rejected by the circuit
+        breaker are left out, they weren't tried at all.
+        """
+        carrier = self.get_carrier(company)
+        if carrier and carrier.supports_batch:
+            results = await self._get_batch(tracknums, carrier)
         else:
+            results = await asyncio.gather(*[self._get(tracknum, company) for tracknum in tracknums])
+            results = dict(zip(tracknums, results))
+        return {tracknum: data for tracknum, data in results.items() if data is not REJECTED}
+
+    def run(self, coro):
+        """
+        Runs a coroutine on the providers event loop and waits for its result
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def close(self):
+        """
+        Closes every session and stops the event loop
+        """
+        async def close_sessions():
+            for session in self.sessions.values():
+                await session.close()
+            self.sessions = {}
+        self.run(close_sessions())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def _get(self, tracknum, company):
+        """
+        Returns cached data if fresh, else joins the request already
+        in flight for this tracknum or starts a new one
+        """
+        key = (tracknum, company)
+        cached = self.cache.get(key)
+        if cached and cached[0] > self.loop.time():
+            return cached[1]
+
+        if key not in self.inflight:
+            self._track(key, asyncio.ensure_future(self._fetch(tracknum, company)))
+
+        # Shielded so that a cancelled caller doesn't cancel it for the rest
+        return await asyncio.shield(self.inflight[key])
+
+    async def _fetch(self, tracknum, company):
+        carrier = self.get_carrier(company)
+        if carrier is None:
             return None
 
-    def _get_oca(self, tracknum: str) -> list:
+        breaker = self.get_breaker(company)
+        async with self._semaphore(company):
+            if not breaker.allow():
+                REQUESTS_REJECTED.inc(carrier=company)
+                return REJECTED
+            start = time.monotonic()
+            data = None
+            try:
+                raw = await carrier.fetch(self._session(carrier.url), tracknum)
+                data = self._parse(carrier, raw)
+            except Exception as inst:
+                log.error("providers: _fetch() " + company + " exception = " + type(inst).__name__ + " - " + str(inst.args[0:]))
+            finally:
+                self._record(breaker, company, data is not None, time.monotonic() - start)
+        return self._remember((tracknum, company), data)
+
+    async def _get_batch(self, tracknums, carrier) -> dict:
+        """
+        Fetches every tracknum that isn't cached nor in flight in
+        batches of carrier.batch_size, then gets each one as usual
+        """
+        company = carrier.name
+        now = self.loop.time()
+        missing = [
+            tracknum for tracknum in tracknums
+            if (tracknum, company) not in self.inflight
+            and self.cache.get((tracknum, company), (0, None))[0] <= now
+        ]
+
+        size = max(carrier.batch_size, 1)
+        for i in range(0, len(missing), size):
+            chunk = missing[i:i + size]
+            batch = asyncio.ensure_future(self._fetch_batch(chunk, carrier))
+            for tracknum in chunk:
+                self._track((tracknum, company), asyncio.ensure_future(self._pick(batch, tracknum)))
+
+        results = await asyncio.gather(*[self._get(tracknum, company) for tracknum in tracknums])
+        return dict(zip(tracknums, results))
+
+    async def _fetch_batch(self, tracknums, carrier) -> dict:
+        """
+        Fetches a batch in one request. Each item is parsed on its
+        own, so a bad one only fails itself. If the whole request
+        fails, every item is retried with a request of its own.
         """
-        Gets tracking data from oca
+        breaker = self.get_breaker(carrier.name)
+        async with self._semaphore(carrier.name):
+            if not breaker.allow():
+                REQUESTS_REJECTED.inc(carrier=carrier.name)
+                return dict.fromkeys(tracknums, REJECTED)
+            start = time.monotonic()
+            raws = None
+            try:
+                raws = await carrier.fetch_many(self._session(carrier.url), tracknums)
+            except Exception as inst:
+                log.error("providers: _fetch_batch() " + carrier.name + " exception = " + type(inst).__name__ + " - " + str(inst.args[0:]))
+            finally:
+                self._record(breaker, carrier.name, raws is not None, time.monotonic() - start)
+
+        if raws is None:
+            results = await asyncio.gather(*[self._fetch(tracknum, carrier.name) for tracknum in tracknums])
+            return dict(zip(tracknums, results))
 
-        Param:
-            - tracknum: tracking number
+        return {
+            tracknum: self._remember((tracknum, carrier.name), self._parse(carrier, raws.get(tracknum)))
+            for tracknum in tracknums
+        }
+
+    @staticmethod
+    def _record(breaker, company, ok, latency):
+        """
+        Feeds the outcome of a request to the breaker and metrics
+        """
+        breaker.record(ok, latency)
+        REQUEST_SECONDS.observe(latency, carrier=company)
+        if not ok:
+            REQUEST_ERRORS.inc(carrier=company)
 
-        Returns:
-            - List of lists, where each each list contains:
-                [date, description]
+    @staticmethod
+    async def _pick(batch, tracknum):
+        return (await batch)[tracknum]
+
+    def _track(self, key, future):
+        """
+        Registers the in-flight request of a key until it's done
+        """
+        self.inflight[key] = future
+        future.add_done_callback(lambda _: self.inflight.pop(key, None))
+
+    def _remember(self, key, data):
+        """
+        Caches successful results, returns data
         """
-        # Define request URL
-        url = "http://www5.oca.com.ar/ocaepakNet/Views/ConsultaTracking/TrackingConsult.aspx/GetTracking"
-    
-        # Get page
+        if data is not None:
+            self.cache[key] = (self.loop.time() + self.cache_ttl, data)
+            self.cache.move_to_end(key)
+            if len(self.cache) > self.CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return data
+
+    @staticmethod
+    def _parse(carrier, raw):
+        if raw is None:
+            return None
         try:
-            response = requests.post(url, json={"numberOfSend": tracknum}, timeout=10)
+            return carrier.parse(raw)
         except Exception as inst:
-            log.error("providers: _get_oca() requests.post exception = " + type(inst).__name__ + " - " + str(inst.args[0:]))
-            return
-
-        # Check for errors
-        if response.status_code != 200:
-            log.error("providers: get_oca_web() status_code exception = " + str(response.status_code))
-            return
-        
-        raw_data = response.json()
-
-        return_list = []
-        for row in raw_data["d"]:
-            
-            # Format date
-            raw_date = row["Date"].replace("/Date(", "").replace(")/", "")
-            date = datetime.fromtimestamp(int(raw_date)/1e3, tz=self.timezone).strftime("%Y-%m-%d %H:%M")
-
-            # Format description
-            description = row["State"].rstrip()
-
-            # Format location
-            location = row["Sucursal"].rstrip()
-
-            # Return data
-            return_list.append({
-                "date":     date,
-                "description":  description,
-                "location": location
-            })
-        return(return_list)
-    
+            log.error("providers: _parse() " + carrier.name + " exception = " + type(inst).__name__ + " - " + str(inst.args[0:]))
+            return None
+
+    def _semaphore(self, company) -> asyncio.Semaphore:
+        """
+        Limits in-flight requests per company.
+        Must be called from the event loop.
+        """
+        if company not in self.semaphores:
+            self.semaphores[company] = asyncio.Semaphore(self.max_in_flight)
+        return self.semaphores[company]
+
+    def _session(self, url) -> aiohttp.ClientSession:
+        """
+        Returns the pooled session for the host of url.
+        Must be called from the event loop.
+        """
+        host = urlsplit(url).netloc
+        if host not in self.sessions:
+            self.sessions[host] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.max_in_flight, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        return self.sessions[host]
+
 
 if __name__ == "__main__":
     prov = Providers()
@@ -83,10 +416,10 @@ if __name__ == "__main__":
     list_text = ""
 
         # Turns it into string
-    for row in info:
+    for event in info:
         list_text += "{}\n{}\n{}\n\n".format(
-            row["date"],
-            row["description"],
-            row["location"]
+            event.date(),
+            event.description,
+            event.location
         )
     print(list_text)
@@ -0,0 +1,58 @@
+# Module imports
+from carriers import TIMEZONE
+
+# Longest message Telegram accepts
+MAX_LENGTH = 4096
+
+def render_events(events, timezone=TIMEZONE, keep=None) -> list:
+    """
+    Renders each event as a block of text, dates in timezone.
+
+    If there are more than keep events, the older ones are
+    collapsed into a single summary block before the rest.
+    """
+    blocks = []
+    if keep is not None and len(events) > keep:
+        older = events[:len(events) - keep]
+        events = events[len(events) - keep:]
+        blocks.append("({} eventos anteriores, desde el {})".format(len(older), older[0].date(timezone)))
+
+    blocks.extend(
+        "\n".join((event.date(timezone), event.description, event.location))
+        for event in events
+    )
+    return blocks
+
+
+def chunk(header, blocks, max_length=MAX_LENGTH, separator="\n\n") -> list:
+    """
+    Joins header and blocks into as few messages as possible,
+    each at most max_length long. Messages are only split
+    between blocks, unless a single block is too long itself.
+    """
+    messages = []
+    current = []
+    length = 0
+    for block in [header] + list(blocks):
+
+        # Way too long, split it anywhere
+        while len(block) > max_length:
+            if current:
+                messages.append(separator.join(current))
+                current, length = [], 0
+            messages.append(block[:max_length])
+            block = block[max_length:]
+        if not block:
+            continue
+
+        added = len(block) + (len(separator) if current else 0)
+        if length + added > max_length:
+            messages.append(separator.join(current))
+            current, length = [], 0
+            added = len(block)
+        current.append(block)
+        length += added
+
+    if current:
+        messages.append(separator.join(current))
+    return messages
@@ -1,94 +1,503 @@
 from apscheduler.schedulers.background import BackgroundScheduler
+import hashlib
+import heapq
+import random
+import threading
+import time
 import logging as log
-from datetime import datetime
+from datetime import datetime, timedelta
+
+# Local imports
+import metrics
+from shards import shard_of
+
+POLLS = metrics.REGISTRY.counter("scheduler_polls_total", "Tracking numbers polled", ["carrier"])
+UPDATES = metrics.REGISTRY.counter("scheduler_updates_total", "Polls that found new info", ["carrier"])
+LAG_SECONDS = metrics.REGISTRY.histogram("scheduler_lag_seconds", "Delay between a poll being due and done", ["carrier"])
+
+
+class PollQueue:
+    """
+    Priority queue of the tracking numbers of one provider,
+    ordered by the time they are due to be polled.
+
+    Deleted tracking numbers are dropped lazily once they reach
+    the top of the heap, so removing one is O(1).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []      # (due, tracknum)
+        self.due = {}       # tracknum -> due time, None while being polled
+        self.intervals = {} # tracknum -> current poll interval
+        self.failures = {}  # tracknum -> consecutive failed polls, if any
+        self.stopped = 0    # polls stopped by the interval policy
+
+    def __len__(self):
+        return len(self.due)
+
+    def __contains__(self, tracknum):
+        return tracknum in self.due
+
+    def push(self, tracknum, due, interval=None, failures=0):
+        """
+        Adds tracknum to the queue, or moves it if already queued
+        """
+        with self.lock:
+            self.due[tracknum] = due
+            if interval:
+                self.intervals[tracknum] = interval
+            if failures:
+                self.failures[tracknum] = failures
+            heapq.heappush(self.heap, (due, tracknum))
+            self._compact()
+
+    def reschedule(self, tracknum, due, interval, failures=0) -> bool:
+        """
+        Puts back a polled tracknum, unless it got deleted meanwhile.
+        Returns False if it did.
+        """
+        with self.lock:
+            if tracknum not in self.due:
+                return False
+            self.due[tracknum] = due
+            self.intervals[tracknum] = interval
+            if failures:
+                self.failures[tracknum] = failures
+            else:
+                self.failures.pop(tracknum, None)
+            heapq.heappush(self.heap, (due, tracknum))
+            return True
+
+    def put_back(self, tracknum, due):
+        """
+        Returns a tracknum that wasn't polled after all to its
+        old due time, unless it got deleted meanwhile
+        """
+        with self.lock:
+            if tracknum in self.due:
+                self.due[tracknum] = due
+                heapq.heappush(self.heap, (due, tracknum))
+
+    def remove(self, tracknum):
+        with self.lock:
+            self.due.pop(tracknum, None)
+            self.intervals.pop(tracknum, None)
+            self.failures.pop(tracknum, None)
+
+    def stop(self, tracknum) -> bool:
+        """
+        Removes a tracknum because it doesn't need polling anymore.
+        Returns False if it got deleted meanwhile.
+        """
+        with self.lock:
+            if self.due.pop(tracknum, False) is False:
+                return False
+            self.intervals.pop(tracknum, None)
+            self.failures.pop(tracknum, None)
+            self.stopped += 1
+            return True
+
+    def pop_due(self, now, limit) -> list:
+        """
+        Returns up to limit tracknums whose due time has passed,
+        as (tracknum, due) tuples. They are marked as being polled
+        until rescheduled.
+        """
+        batch = []
+        with self.lock:
+            while self.heap and len(batch) < limit:
+                due, tracknum = self.heap[0]
+                if self.due.get(tracknum) != due:
+                    heapq.heappop(self.heap)    # Stale entry
+                    continue
+                if due > now:
+                    break
+                heapq.heappop(self.heap)
+                self.due[tracknum] = None
+                batch.append((tracknum, due))
+        return batch
+
+    def _compact(self):
+        """
+        Rebuilds the heap when stale entries pile up
+        """
+        if len(self.heap) > 2 * len(self.due) + 64:
+            self.heap = [(due, num) for num, due in self.due.items() if due is not None]
+            heapq.heapify(self.heap)
 
 
 class Sched:
-    def __init__(self, db, prov):
+    def __init__(self, db, prov, shards=None, batch_size=50):
         # Start the scheduler
         self.sched = BackgroundScheduler()
         self.sched.start()
         self.db = db
         self.prov = prov
-        
+
+        # Shards polled by this process, all of them if None
+        self.shards = shards
+
         # Set track time
-        self.JOB_INTERVAL = 30 * 60   # seconds
+        self.JOB_INTERVAL = 30 * 60     # seconds
+        self.JITTER = 0.1               # fraction of the poll interval
+        self.TICK = 10                  # seconds between dispatcher runs
+        self.BATCH_SIZE = batch_size    # max polls per provider and tick
+        self.INFO_MAX_AGE = 60 * 60     # seconds before stored info needs a live fetch
+
+        # One poll queue and dispatcher job per provider
+        self.queues = {}
+        self.lock = threading.Lock()
+
+        # Adds and deletes of jobs, one at a time
+        self.jobs_lock = threading.Lock()
+
+        # Last successful poll, (tracknum, company) -> epoch
+        self.last_polled = {}
 
         # Disable below warning-level logs
         log.getLogger('apscheduler.executors.default').setLevel(log.WARNING)
         log.getLogger('apscheduler.scheduler').setLevel(log.WARNING)
 
-        # After restart
-        self._add_existing_tracknums()
-
         # Placeholder so that no error happens
         self.bot = None
-        
+
+        # Queue sizes, read from stats() when scraped
+        for name, key, help in (
+            ("shipments_tracked", "shipments", "Tracking numbers in the poll queue"),
+            ("scheduler_overdue", "overdue", "Tracking numbers past their due time"),
+            ("scheduler_stopped", "stopped", "Polls stopped by the interval policy"),
+            ("scheduler_failing", "failing", "Tracking numbers whose last poll failed")):
+            metrics.REGISTRY.gauge(
+                name, help, ["carrier"],
+                callback=lambda key=key: {(company, ): stats[key] for company, stats in self.stats().items()})
+
+        # After restart, in the background so the bot starts right
+        # away. A worker first needs to lease its shards.
+        if shards is None:
+            threading.Thread(target=self._add_existing_tracknums, name="sched-startup", daemon=True).start()
+        else:
+            self.sched.add_job(
+                self._rebalance, 'interval', seconds=shards.RENEW, coalesce=True, max_instances=1,
+                id='shards', next_run_time=datetime.now())
+            self.sched.add_job(
+                self._run_commands, 'interval', seconds=shards.COMMANDS, coalesce=True, max_instances=1,
+                id='commands')
+
     def add_tracknum_job(self, id, tracknum, company):
 
         # Check if already exists, if it doesn't, add it
-        # and run it now to get the info
-        if not self.sched.get_job(job_id=tracknum+company):
-            log.info('sched: add_tracknum_job() = Adding job id: ' +tracknum+company)
-            self.sched.add_job(
-                lambda: self._update_tracking(tracknum, company),
-                'interval',
-                seconds=self.JOB_INTERVAL,
-                coalesce=True,
-                id=tracknum+company,
-                next_run_time=datetime.now()
-            )
+        # and poll it now to get the info
+        queue = self._get_queue(company)
+        with self.jobs_lock:
+            added = tracknum not in queue
+            if added:
+                log.info('sched: add_tracknum_job() = Adding job id: ' + tracknum + company)
+                queue.push(tracknum, time.time())
+
+        # Unless it was stopped with its info already stored,
+        # then the poll won't find anything new to send
+        if added and not self.db.get_tracknum_hash(tracknum, company):
+            return
 
         # Send existing tracking info if it's not adding a job
-        elif id:
-            info = self.prov.get(tracknum, company)
+        if id:
             log.info('sched: add_tracknum_job() = Sending existing info')
-            self.bot.send_update([id], tracknum, company, info, False)
-            
+            self.send_unseen(id, tracknum, company)
+
     def del_tracknum_job(self, tracknum, company):
-        log.info('sched: del_tracknum_job() = Removing job id: ' + tracknum + company)
-        self.sched.remove_job(job_id=tracknum+company)        
-    
-    def _add_existing_tracknums(self):
+
+        # The front-end may have deleted the history this one cached
+        self.db.forget_tracknum_hash(tracknum, company)
+
+        with self.jobs_lock:
+
+            # Someone may have followed it again meanwhile
+            if self.db.count_followers(tracknum, company):
+                return
+            log.info('sched: del_tracknum_job() = Removing job id: ' + tracknum + company)
+            if company in self.queues:
+                self.queues[company].remove(tracknum)
+            self.last_polled.pop((tracknum, company), None)
+
+    def send_unseen(self, id, tracknum, company) -> bool:
+        """
+        Sends a follower the events it wasn't sent yet, refreshing
+        the stored info first if it's older than INFO_MAX_AGE.
+        Returns False if there were none.
+        """
+        refreshed = self._refresh(tracknum, company)
+        return self._notify(tracknum, company, False, id) or refreshed
+
+    def _refresh(self, tracknum, company) -> bool:
+        """
+        Live fetch of a tracking number if its last poll is older
+        than INFO_MAX_AGE. Returns True if followers were notified.
+        """
+        polled = self.last_polled.get((tracknum, company), 0)
+        if time.time() - polled > self.INFO_MAX_AGE:
+            log.info('sched: _refresh() = Stored info too old, fetching ' + tracknum + " " + company)
+            return self._update_tracking(tracknum, company, self.prov.get(tracknum, company))
+        return False
+
+    def _notify(self, tracknum, company, new, id=None) -> bool:
         """
-        Adds existing tracking numbers after reboot
+        Sends every follower (or only id) the events it wasn't
+        sent yet. Returns False if there were none.
         """
-        tracknum_list = self.db.get_tracknums_and_company()
-        
-        if tracknum_list:
-            for num in tracknum_list:
-                self.add_tracknum_job(None, num[0], num[1])
+        unseen = self.db.take_unseen_events(tracknum, company, id)
+        for followers, events in unseen:
+            self.bot.send_update(followers, tracknum, company, events, new)
+        return bool(unseen)
 
-    def _update_tracking(self, tracknum, company):
+    def stats(self) -> dict:
         """
-        Job that executes regularly and checks for changes
+        Returns, for each provider queue, the number of shipments,
+        how many are overdue, how many were stopped, how many failed
+        their last poll and how many are polled at each interval
+        (in minutes)
         """
-        log.info('sched: _update_tracking() = Updating tracking ' + tracknum + " " + company)
+        now = time.time()
+        stats = {}
+        for company, queue in list(self.queues.items()):
+            with queue.lock:
+                dues = list(queue.due.values())
+                intervals = list(queue.intervals.values())
+                failing = len(queue.failures)
+                stopped = queue.stopped
+
+            by_interval = {}
+            for interval in intervals:
+                minutes = int(interval // 60)
+                by_interval[minutes] = by_interval.get(minutes, 0) + 1
+
+            stats[company] = {
+                "shipments":    len(dues),
+                "polling":      sum(1 for due in dues if due is None),
+                "overdue":      sum(1 for due in dues if due is not None and due <= now),
+                "stopped":      stopped,
+                "failing":      failing,
+                "intervals":    by_interval,
+                "breaker":      self.prov.get_breaker(company).state
+            }
+        return stats
+
+    def _get_queue(self, company) -> PollQueue:
+        """
+        Returns the poll queue of a provider, creating it and
+        its dispatcher job the first time
+        """
+        with self.lock:
+            if company not in self.queues:
+                self.queues[company] = PollQueue()
+                self.sched.add_job(
+                    self._dispatch,
+                    'interval',
+                    args=[company],
+                    seconds=self.TICK,
+                    coalesce=True,
+                    max_instances=1,
+                    id='dispatch_' + company,
+                    next_run_time=datetime.now() + timedelta(seconds=self.TICK)
+                )
+            return self.queues[company]
+
+    def _add_existing_tracknums(self, shards=None):
+        """
+        Adds the existing tracking numbers (or only the ones in
+        shards) as they're read from the database, resuming their
+        stored poll schedule. The overdue ones, and the ones never
+        polled, get their first poll at a random time within
+        JOB_INTERVAL, so a restart doesn't poll them all at once.
+        """
+        now = time.time()
+        added = stopped = 0
+        for tracknum, company, polled, due, interval, failures in self.db.get_shipments():
+            if shards is not None and shard_of(tracknum, company, self.shards.count) not in shards:
+                continue
+            queue = self._get_queue(company)
+
+            if polled is not None:
+                self.last_polled.setdefault((tracknum, company), polled)
+
+            # Delivered a while ago
+            if interval == 0:
+                with queue.lock:
+                    queue.stopped += 1
+                stopped += 1
+                continue
+
+            if due is None:
+                due = polled + self.JOB_INTERVAL if polled is not None else 0
+            if due <= now:
+                due = now + random.random() * self.JOB_INTERVAL
+
+            # It could have been added meanwhile
+            if tracknum not in queue:
+                queue.push(tracknum, due, interval, failures)
+                added += 1
+        log.info('sched: _add_existing_tracknums() = Added ' + str(added) + ' existing tracking numbers, '
+            + str(stopped) + ' stopped')
+
+    def _rebalance(self):
+        """
+        Job that renews the shard leases of a worker, dropping
+        the shipments of lost shards and loading the gained ones
+        """
+        gained, lost = self.shards.renew()
+
+        # Every worker sends with the same bot, so they share its limit
+        if self.bot is not None:
+            self.bot.notifier.share(self.shards.owners)
+        if lost:
+            for company, queue in list(self.queues.items()):
+                with queue.lock:
+                    tracknums = list(queue.due)
+                for tracknum in tracknums:
+                    if shard_of(tracknum, company, self.shards.count) in lost:
+                        queue.remove(tracknum)
+        if gained:
+            self._add_existing_tracknums(gained)
+
+    def _run_commands(self):
+        """
+        Job that runs what the front-end left for the shards of a worker
+        """
+        for action, id, tracknum, company in self.shards.take_commands():
+            try:
+                if action == "add":
+                    self.add_tracknum_job(id, tracknum, company)
+                elif action == "del":
+                    self.del_tracknum_job(tracknum, company)
+                elif action == "info":
+                    if not self.send_unseen(id, tracknum, company):
+                        self.bot.send_nothing_new(id)
+                    self.bot.send_menu_prompt(id)
+            except Exception:
+                log.exception('sched: _run_commands() = Error running ' + action + " " + tracknum + " " + company)
+
+    def _next_interval(self, tracknum, company, failures=0):
+        """
+        Asks the provider policy how long until the next poll,
+        given the consecutive failed polls. Returns None if it
+        shouldn't be polled anymore.
+        """
+        description, changed = self.db.get_tracknum_activity(tracknum, company)
+        quiet_for = time.time() - changed if changed is not None else 0
+        return self.prov.get_policy(company).interval(description, quiet_for, failures)
+
+    def _next_due(self, now, interval) -> float:
+        """
+        Next poll time, jittered so polls don't line up again
+        """
+        jitter = random.uniform(-self.JITTER, self.JITTER)
+        return now + interval * (1 + jitter)
+
+    def _dispatch(self, company):
+        """
+        Job that executes every TICK for each provider and polls
+        a bounded batch of the due tracking numbers
+        """
+        queue = self.queues[company]
+
+        # Leave everything due while the provider is down,
+        # and only send probes when it's being tested
+        breaker = self.prov.get_breaker(company)
+        if breaker.retry_in() > 0:
+            return
+        limit = self.BATCH_SIZE if breaker.state == breaker.CLOSED else breaker.probes
+
+        now = time.time()
+        batch = queue.pop_due(now, limit)
+        if not batch:
+            return
+
+        # Fetch the whole batch concurrently on the providers loop
+        tracknums = [tracknum for tracknum, _ in batch]
+        try:
+            results = self.prov.run(self.prov.get_many(tracknums, company))
+        except Exception:
+            log.exception('sched: _dispatch() = Error fetching batch for ' + company)
+            results = dict.fromkeys(tracknums)
+
+        # The breaker opened midway, the rest keep their turn
+        for tracknum, due in batch:
+            if tracknum not in results:
+                queue.put_back(tracknum, due)
+            else:
+                LAG_SECONDS.observe(max(now - due, 0), carrier=company)
+        POLLS.inc(len(results), carrier=company)
+
+        states = []
+        for tracknum in tracknums:
+
+            # Rejected, or deleted while being polled
+            if tracknum not in results or tracknum not in queue:
+                continue
+            info = results[tracknum]
+            try:
+                self._update_tracking(tracknum, company, info)
+            except Exception:
+                log.exception('sched: _dispatch() = Error updating ' + tracknum + " " + company)
+
+            now = time.time()
+            polled = now if info else None
+            failures = 0 if info else queue.failures.get(tracknum, 0) + 1
+
+            try:
+                interval = self._next_interval(tracknum, company, failures)
+            except Exception:
+                log.exception('sched: _dispatch() = Error getting interval for ' + tracknum + " " + company)
+                interval = self.JOB_INTERVAL
+
+            if interval is None:
+                if queue.stop(tracknum):
+                    log.info('sched: _dispatch() = Stopped polling ' + tracknum + " " + company)
+                    states.append((tracknum, polled, None, 0, failures))
+            else:
+                due = self._next_due(now, interval)
+                if queue.reschedule(tracknum, due, interval, failures):
+                    states.append((tracknum, polled, due, interval, failures))
+
+        # Stored together, so restarts resume the same schedule
+        try:
+            self.db.set_poll_states(company, states)
+        except Exception:
+            log.exception('sched: _dispatch() = Error storing poll states for ' + company)
+
+    def _update_tracking(self, tracknum, company, info):
+        """
+        Checks the fetched info of a tracking number for changes,
+        returns True if followers were notified
+        """
+        log.debug('sched: _update_tracking() = Updating tracking ' + tracknum + " " + company)
 
-        info = self.prov.get(tracknum, company)
-        new_info = []
-        
         # Check if it has location and return if no data
         if not info:
-            log.info('sched: _update_tracking() = No provider data')
-            return
-            
-        for row in info:
-            date = row["date"]
-            description = row["description"]
-            location = row["location"]
-
-            # Check if it's new info and add it to database
-            is_new_info = self.db.add_tracknum_info(tracknum, date, company, description, location)
-            if is_new_info:
-                new_info.append(row)
-            
-        
-        # If any info is new, send update to bot        
+            log.debug('sched: _update_tracking() = No provider data')
+            return False
+        self.last_polled[(tracknum, company)] = time.time()
+
+        # Skip it all if the history didn't change since last poll
+        fingerprint = self._fingerprint(info)
+        if self.db.get_tracknum_hash(tracknum, company) == fingerprint:
+            log.debug('sched: _update_tracking() = No new info')
+            return False
+
+        # Add it to database, keeping only what's new
+        new_info = self.db.add_tracknum_info_bulk(tracknum, company, info, fingerprint)
+
+        # If any info is new, send update to bot
         if new_info:
             log.info('sched: _update_tracking() = New info detected')
-            ids = self.db.get_ids_for_tracknum(tracknum, company)
-            log.info('sched: _update_tracking() = Sending info update to bot')
-            self.bot.send_update(ids, tracknum, company, new_info, True)
-        else:
-            log.info('sched: _update_tracking() = No new info')
+            UPDATES.inc(carrier=company)
+            return self._notify(tracknum, company, True)
+        log.debug('sched: _update_tracking() = No new info')
+        return False
+
+    @staticmethod
+    def _fingerprint(info) -> str:
+        """
+        Hash of the provider data, regardless of the row order
+        """
+        rows = sorted("{}\x1f{}\x1f{}".format(*event) for event in info)
+        return hashlib.blake2b("\x1e".join(rows).encode(), digest_size=16).hexdigest()
@@ -0,0 +1,84 @@
+# Module imports
+import os
+import socket
+import zlib
+import logging as log
+
+def shard_of(tracknum, company, count) -> int:
+    """
+    Shard of a (tracknum, company) key, the same on every process
+    """
+    return zlib.crc32((company + "\x1f" + tracknum).encode()) % count
+
+
+class Shards:
+    """
+    Poll ownership of a worker process.
+
+    Shipments are split in count shards by the hash of their key.
+    Each worker leases a fair share of them in the database and
+    renews the leases every RENEW seconds. If a worker dies, its
+    leases expire after TTL and the other workers take its shards.
+    """
+    TTL = 60
+    RENEW = 15
+    COMMANDS = 2    # seconds between checks of the inbox
+
+    def __init__(self, db, count, owner=None):
+        self.db = db
+        self.count = count
+        self.owner = owner or "{}:{}".format(socket.gethostname(), os.getpid())
+        self.owned = set()
+        self.owners = 1     # live workers, including this one
+
+    def owns(self, tracknum, company) -> bool:
+        return shard_of(tracknum, company, self.count) in self.owned
+
+    def renew(self) -> tuple:
+        """
+        Renews the leases, returns the sets of shards gained and lost
+        """
+        leased, self.owners = self.db.lease_shards(self.owner, self.count, self.TTL)
+        leased = set(leased)
+        gained, lost = leased - self.owned, self.owned - leased
+        self.owned = leased
+        if gained or lost:
+            log.info("shards: renew() = " + self.owner + " owns " + str(len(leased)) + " of " + str(self.count) + " shards")
+        return gained, lost
+
+    def release(self):
+        self.db.release_shards(self.owner)
+        self.owned = set()
+
+    def take_commands(self) -> list:
+        """
+        Returns the commands left for the owned shards
+        """
+        return self.db.take_commands(sorted(self.owned))
+
+
+class Remote:
+    """
+    Takes the place of Sched in the front-end process. Instead of
+    polling, it hands each request to the worker that owns the
+    shipment, which runs it the next time it checks its inbox.
+    """
+    def __init__(self, db, count):
+        self.db = db
+        self.count = count
+
+    def add_tracknum_job(self, id, tracknum, company):
+        self._send("add", id, tracknum, company)
+
+    def del_tracknum_job(self, tracknum, company):
+        self._send("del", None, tracknum, company)
+
+    def send_unseen(self, id, tracknum, company):
+        """
+        The worker answers the user, even if there's nothing new,
+        so it returns None instead of whether anything was sent
+        """
+        self._send("info", id, tracknum, company)
+
+    def _send(self, action, id, tracknum, company):
+        self.db.add_command(shard_of(tracknum, company, self.count), action, id, tracknum, company)
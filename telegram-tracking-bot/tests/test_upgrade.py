@@ -0,0 +1,52 @@
+"""
+Upgrades a database made by the first version of the bot, whose
+events had their dates stored as text, and polls it again.
+
+    python -m pytest tests
+"""
+# Module imports
+import json
+import os
+import sqlite3
+import sys
+
+# Local imports
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from carriers.oca import Oca
+from database import Database
+
+# OCA times have seconds, the old dates didn't
+PAYLOAD = json.dumps({"d": [
+    {"Date": "/Date(1609502437123)/", "State": "Ingresado   ", "Sucursal": "SUC. PALERMO "},
+    {"Date": "/Date(1609592459000)/", "State": "En distribución", "Sucursal": "SUC. CORDOBA CENTRO"},
+    {"Date": "/Date(1609601401999)/", "State": "Entregado", "Sucursal": "SUC. CORDOBA CENTRO"}
+]}).encode()
+
+
+def make_baseline(path, events):
+    """
+    Database as the first version left it, with two followers
+    that were already sent the whole history
+    """
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE track_nums (user INTEGER, tracknum TEXT, company TEXT, name TEXT)")
+    conn.execute("CREATE TABLE track_info (tracknum TEXT, company TEXT, date TEXT, description TEXT, location TEXT)")
+    conn.executemany("INSERT INTO track_nums VALUES (?, 'X1', 'oca', 'envio')", [(1, ), (2, )])
+    conn.executemany(
+        "INSERT INTO track_info VALUES ('X1', 'oca', ?, ?, ?)",
+        [(event.date(), event.description, event.location) for event in events])
+    conn.commit()
+    conn.close()
+
+
+def test_upgraded_history_matches_new_polls(tmp_path):
+    events = Oca().parse(PAYLOAD)
+    path = str(tmp_path / "database.db")
+    make_baseline(path, events)
+
+    db = Database(path)
+    assert db.get_existing_info("X1", "oca") == events
+    assert db.add_tracknum_info_bulk("X1", "oca", Oca().parse(PAYLOAD), "hash") == []
+    assert db.take_unseen_events("X1", "oca") == []
+    assert len(db.get_existing_info("X1", "oca")) == len(events)
+